@@ -0,0 +1,49 @@
+import os
+import sys
+import argparse
+import subprocess
+
+###################################################
+#
+# Import-time benchmark of bp12_tools: time of
+# `import bp12_tools` plus the modules a batch worker
+# needs, each in a fresh interpreter
+#
+# python benchmarks/import_time.py [--budget 1.5]
+#
+###################################################
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+HEAVY_MODULES = ['matplotlib', 'cartopy', 'scipy', 'statsmodels', 'pymannkendall']
+
+def time_import(stmt, nrepeat=5):
+    '''
+    best wall time (s) of stmt over nrepeat fresh interpreters and
+    the heavy modules it pulled in
+    '''
+    code = (f"import sys, time; sys.path.insert(0, {SRC_PATH!r}); t0 = time.perf_counter(); {stmt}; "
+            f"dt = time.perf_counter() - t0; "
+            f"print(dt, *sorted(set(m.split('.')[0] for m in sys.modules) & set({HEAVY_MODULES!r})))")
+    best, heavy = None, []
+    for i in range(nrepeat):
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, 
+                             text=True, check=True).stdout.split()
+        if (best is None) or (float(out[0]) < best):
+            best, heavy = float(out[0]), out[1:]
+    return best, heavy
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='bp12_tools import-time benchmark')
+    parser.add_argument('--budget', type=float, default=1.5, help='seconds')
+    args = parser.parse_args(argv)
+
+    ok = True
+    for stmt in ['import bp12_tools', 
+                 'import bp12_tools; bp12_tools.chpc_utils; bp12_tools.batch_utils']:
+        seconds, heavy = time_import(stmt)
+        ok = ok and (seconds <= args.budget) and not heavy
+        print(f"{stmt}: {seconds:.3f} s (budget {args.budget} s), heavy modules: {heavy or 'none'}")
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,16 @@
 __version__ = "0.0"
 __author__ = "Nicolette Chang"
 
-__all__ = ["model_utils", "chpc_utils", "grid_utils", "analysis_utils", "plot_utils"]
-
-# Import the submodules
-from . import model_utils
-from . import chpc_utils
-from . import grid_utils
-from . import analysis_utils
-from . import plot_utils
+__all__ = ["model_utils", "chpc_utils", "grid_utils", "analysis_utils", "clim_utils", "phenology_utils", "physics_utils", "batch_utils", "regrid_utils", "plot_utils"]
+
+# Submodules are imported on first access (bp12_tools.chpc_utils, ...)
+# so e.g. batch workers do not pay for matplotlib/cartopy/scipy
+import importlib
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
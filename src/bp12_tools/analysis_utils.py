@@ -2,10 +2,8 @@ import pandas as pd
 import numpy as np
 from math import pi
 import xarray as xr
-from scipy import stats
-# trend analysis
-import pymannkendall as mk
-import statsmodels.api as sm
+import bp12_tools.grid_utils as gu
+# scipy, dask.array and pymannkendall are imported in the functions using them
 from io import StringIO
 import contextlib
 
@@ -34,6 +32,7 @@ def get_pdf(var_in, perc_outlier=None):
     If perc_outlier, also return the lower and upper percentage of gridpoints 
     that are outliers.
     '''
+    from scipy import stats
     # remove outliers
     var_in = var_in.stack(ll=('lat','lon')).sortby('ll')
     Q1, Q3 = np.nanpercentile(var_in, 25), np.nanpercentile(var_in, 75)
@@ -55,21 +54,216 @@ def get_pdf(var_in, perc_outlier=None):
         return var_sort, pdf_var
 
 
+################################################### 
+#
+# Histogram based PDF and outlier statistics
+# (fixed bins, mergeable across chunks/time steps)
+# 
+################################################### 
+
+def _hist_partials(var_blk, label_blk, slot_blk, edges, nbiome):
+    '''
+    count, sum and sum of squares per (time, biome label, bin)
+    for one (time, lat, lon) block, returns (time, 1, 1, nbiome, nbin, 3)
+    '''
+    nt, nbin = var_blk.shape[0], edges.size - 1
+    lab = label_blk[slot_blk]
+    valid = (lab >= 0) & ~np.isnan(var_blk)
+    binind = np.searchsorted(edges, var_blk, side='right') - 1
+    flat = (((np.arange(nt)[:, None, None] * nbiome + lab) * nbin + binind))[valid]
+    x = var_blk[valid]
+    nflat = nt * nbiome * nbin
+    sums = np.stack([np.bincount(flat, minlength=nflat),
+                     np.bincount(flat, weights=x, minlength=nflat),
+                     np.bincount(flat, weights=x*x, minlength=nflat)], axis=-1)
+    return sums.reshape(nt, 1, 1, nbiome, nbin, 3)
+
+def get_hist(var_in, bins, biome_in=None, biome_vals=None):
+    '''
+    Fixed-bin histogram of a (time, lat, lon) variable per time step
+    and biome (biome mask biome_in, see gu.get_biome_stats), 
+    or over the whole domain if no mask is given.
+    bins are the finite bin edges, values outside are kept in 
+    open-ended first/last bins. Histograms of different chunks, 
+    time steps or years are merged by summing.
+    returns Dataset of count, sum and sumsq (time, [biome], bin)
+    '''
+    import dask.array as da
+    has_biome = biome_in is not None
+    if not has_biome:
+        biome_in, biome_vals = xr.zeros_like(var_in.isel(time=0), dtype=float), [0]
+    var_in = var_in.transpose('time', 'lat', 'lon')
+    vardata, labels, slots, biome_vals = gu.get_biome_blocks(var_in, biome_in, biome_vals)
+    edges = np.concatenate([[-np.inf], np.asarray(bins, dtype=float), [np.inf]])
+    nbiome, nbin = biome_vals.size, edges.size - 1
+    
+    partials = da.blockwise(_hist_partials, 'tyxbks', 
+                            vardata, 'tyx', labels, 'myx', slots, 't',
+                            edges=edges, nbiome=nbiome, 
+                            new_axes={'b': nbiome, 'k': nbin, 's': 3},
+                            adjust_chunks={'y': lambda c: 1, 'x': lambda c: 1},
+                            concatenate=True, dtype=float)
+    sums = partials.sum(axis=(1, 2))
+    
+    dims = ('time', 'biome', 'bin')
+    ds_out = xr.Dataset(
+        data_vars={'count': (dims, sums[..., 0]), 
+                   'sum': (dims, sums[..., 1]), 
+                   'sumsq': (dims, sums[..., 2])},
+        coords={'time': var_in.time, 'biome': biome_vals, 
+                'bin_lo': ('bin', edges[:-1]), 'bin_hi': ('bin', edges[1:])})
+    if not has_biome:
+        ds_out = ds_out.isel(biome=0, drop=True)
+    if not isinstance(var_in.data, da.Array):
+        ds_out = ds_out.compute()
+    return ds_out
+
+def _hist_quantile(count, lo, hi, q):
+    '''
+    q-th quantile from binned counts (last axis), 
+    interpolated linearly within the bin
+    '''
+    csum = np.cumsum(count, axis=-1)
+    target = q * csum[..., -1:]
+    k = np.minimum((csum < target).sum(axis=-1, keepdims=True), count.shape[-1] - 1)
+    ck = np.take_along_axis(csum, k, axis=-1)
+    nk = np.take_along_axis(count, k, axis=-1)
+    lo, hi = np.broadcast_to(lo, count.shape), np.broadcast_to(hi, count.shape)
+    lok, hik = np.take_along_axis(lo, k, axis=-1), np.take_along_axis(hi, k, axis=-1)
+    # open-ended bins collapse onto their finite edge
+    lok, hik = np.where(np.isinf(lok), hik, lok), np.where(np.isinf(hik), lok, hik)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.clip((target - (ck - nk)) / nk, 0, 1)
+        qval = lok + frac * (hik - lok)
+    return np.where(csum[..., -1:] > 0, qval, np.nan)[..., 0]
+
+def _hist_below(count, lo, hi, val):
+    '''
+    number of values below val from binned counts (last axis)
+    '''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.clip((val[..., None] - lo) / (hi - lo), 0, 1)
+    frac = np.where(np.isinf(lo), (val[..., None] >= hi), frac)
+    frac = np.where(np.isinf(hi), 0, frac)
+    return (count * frac).sum(axis=-1)
+
+def get_pdf_stats(ds_hist, dim=None):
+    '''
+    IQR outlier bounds, percent of values below/above them and 
+    normal PDF of the values within bounds (as in get_pdf) 
+    from histograms made with get_hist, summed over dim first.
+    Quantiles are exact to within one bin width.
+    returns Dataset with q1, q3, lower, upper, perc_lower, perc_upper,
+    mean, std (within bounds), pdf (normal, at bin centres) and 
+    density (empirical, all values)
+    '''
+    from scipy import stats
+    if dim is not None:
+        ds_hist = ds_hist.sum(dim)
+    count, lo, hi = ds_hist['count'], ds_hist.bin_lo, ds_hist.bin_hi
+    ntot = count.sum('bin')
+    
+    def hist_apply(func, *args):
+        return xr.apply_ufunc(func, count, lo, hi, *args, 
+                              input_core_dims=[['bin']]*3 + [[]]*len(args),
+                              dask='parallelized', output_dtypes=[float])
+    q1, q3 = hist_apply(_hist_quantile, 0.25), hist_apply(_hist_quantile, 0.75)
+    iqr = q3 - q1
+    upper, lower = q3 + 1.5*iqr, q1 - 1.5*iqr
+    with np.errstate(invalid='ignore', divide='ignore'):
+        perc_lower = hist_apply(_hist_below, lower) / ntot * 100
+        perc_upper = (1 - hist_apply(_hist_below, upper) / ntot) * 100
+    
+        # moments of the bins within the outlier bounds
+        inside = (lo >= lower) & (hi <= upper)
+        n_in = count.where(inside, 0).sum('bin')
+        mean = ds_hist['sum'].where(inside, 0).sum('bin') / n_in
+        std = np.sqrt((ds_hist['sumsq'].where(inside, 0).sum('bin') / n_in - mean**2).clip(min=0))
+        centre = (0.5 * (lo + hi)).where(np.isfinite(lo) & np.isfinite(hi))
+        pdf = xr.apply_ufunc(stats.norm.pdf, centre, mean, std, dask='allowed')
+        density = count / ntot / (hi - lo)
+    
+    return xr.Dataset({'q1': q1, 'q3': q3, 'lower': lower, 'upper': upper, 
+                       'perc_lower': perc_lower, 'perc_upper': perc_upper, 
+                       'mean': mean, 'std': std, 'pdf': pdf, 'density': density, 
+                       'count': ntot}).assign_coords(bin_centre=centre).transpose(..., 'bin')
+
+def get_pdf_clim(ds_hist):
+    '''
+    PDF statistics per calendar month (1-12) and for all 
+    times together (month 13) from histograms made with get_hist
+    '''
+    monthly = ds_hist.groupby('time.month').sum('time')
+    annual = ds_hist.sum('time').expand_dims(month=[13])
+    return get_pdf_stats(xr.concat([monthly, annual], dim='month'))
+
+def get_trend_time(da_in):
+    '''
+    time axis of da_in as float, in days for datetimes
+    '''
+    tcoord = da_in['time']
+    if np.issubdtype(tcoord.dtype, np.datetime64):
+        return (tcoord - tcoord[0]) / np.timedelta64(1, 'D')
+    return tcoord.astype(float)
+
+def get_trend_stats(da_in, anomalies=False):
+    '''
+    Least-squares linear trend along time (or time_counter) at every 
+    gridpoint from the sums of t, t^2, y, y^2 and t*y over valid values, 
+    so NaNs (land, sea ice) are skipped and dask input is read in one pass.
+    returns Dataset of slope (per day for datetimes, else per time unit), 
+    intercept (at the first time), r2, stderr of the slope and count,
+    with anomalies=True also the detrended anomalies (time, ...)
+    '''
+    if not 'time' in da_in.dims:
+        da_in = da_in.rename({'time_counter':'time'})
+    t = get_trend_time(da_in)
+    # centre time for precision, shifted back for the intercept
+    tmid = float(t.mean())
+    tc = t - tmid
+    y = da_in.astype(float)
+    valid = y.notnull()
+    tv = tc.where(valid)
+    
+    n = valid.sum('time')
+    st, stt = tv.sum('time'), (tv**2).sum('time')
+    sy, syy = y.sum('time'), (y**2).sum('time')
+    sty = (tv * y).sum('time')
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sstt = stt - st**2 / n
+        ssyy = syy - sy**2 / n
+        ssty = sty - st * sy / n
+        slope = (ssty / sstt).where(n > 1)
+        intercept = sy / n - slope * (st / n + tmid)
+        r2 = ssty**2 / (sstt * ssyy)
+        sse = (ssyy - slope * ssty).clip(min=0)
+        stderr = np.sqrt(sse / (n - 2) / sstt).where(n > 2)
+    
+    ds_out = xr.Dataset({'slope': slope, 'intercept': intercept, 
+                         'r2': r2, 'stderr': stderr, 'count': n})
+    if anomalies:
+        ds_out['anomaly'] = y - (intercept + slope * t)
+    return ds_out
+
 def get_trend(da_in):
     '''
     Get trend in a timeseries with dimension time or time_counter
+    returns the fitted linear trend at each time, 
+    see get_trend_stats for slope etc. without the fitted field
     '''
     if not 'time' in da_in.dims:
         da_in = da_in.rename({'time_counter':'time'})        
-    p = da_in.polyfit(dim="time", deg=1)
-    trend = xr.polyval(da_in.time, p.polyfit_coefficients)
-    return trend
+    ds_trend = get_trend_stats(da_in)
+    trend = ds_trend.intercept + ds_trend.slope * get_trend_time(da_in)
+    return trend.transpose('time', ...)
 
 def check_trend(da_in, testnum=0):
     '''
     Check significance of trend in a timeseries
     default option is Original Mann-Kendall Test
     '''
+    import pymannkendall as mk
     f = StringIO()
     with contextlib.redirect_stdout(f):
         # Original MK
@@ -87,3 +281,226 @@ def check_trend(da_in, testnum=0):
         if testnum ==5:
             trend, h, p, z, Tau, s, var_s, slope, intercept = mk.seasonal_test(da_in, alpha=0.05)
         return trend, p
+
+################################################### 
+#
+# Seasonal cycle reproducibility (SCR) and amplitude
+# 
+################################################### 
+
+def _scr_core(x, slots, years, nslot):
+    '''
+    SCR, amplitude and climatological cycle along the last axis of x
+    accumulating one year at a time: the sum of normalised centred 
+    yearly cycles U and of centred cycles S give the mean correlation 
+    of the yearly cycles with the mean cycle as <U,S> / (K |S|)
+    '''
+    shape = x.shape[:-1]
+    x = np.asarray(x, dtype=float).reshape(-1, x.shape[-1])
+    npts = x.shape[0]
+    usum, ssum, csum = (np.zeros((npts, nslot)) for i in range(3))
+    nyear = np.zeros(npts)
+    for yr in np.unique(years):
+        it = np.where(years == yr)[0]
+        onehot = (slots[it, None] == np.arange(nslot)).astype(float)
+        xyr = x[:, it]
+        valid = ~np.isnan(xyr)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cycle = (np.where(valid, xyr, 0) @ onehot) / (valid @ onehot)
+        # only complete, non-constant yearly cycles are used
+        anom = cycle - cycle.mean(axis=1, keepdims=True)
+        norm = np.sqrt((anom**2).sum(axis=1))
+        use = np.isfinite(norm) & (norm > 0)
+        usum[use] += anom[use] / norm[use, None]
+        ssum[use] += anom[use]
+        csum[use] += cycle[use]
+        nyear += use
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scr = (usum * ssum).sum(axis=1) / (nyear * np.sqrt((ssum**2).sum(axis=1)))
+        clim = csum / nyear[:, None]
+    amp = clim.max(axis=1) - clim.min(axis=1)
+    return scr.reshape(shape), amp.reshape(shape), clim.reshape(shape + (nslot,))
+
+def get_scr(da_in, nslot=12):
+    '''
+    Seasonal cycle reproducibility at every gridpoint: mean correlation
+    of each year's seasonal cycle with the mean seasonal cycle, 
+    with the amplitude (max - min) of the mean cycle.
+    da_in is 5-day or monthly data along time (or time_counter), 
+    cycles are built with nslot=12 monthly or 73 5-day slots.
+    Years are streamed one at a time within each spatial chunk 
+    and chunks are processed in parallel under dask.
+    returns Dataset of SCR, amplitude, clim (slot) and nyears
+    '''
+    if not 'time' in da_in.dims:
+        da_in = da_in.rename({'time_counter':'time'})
+    if da_in.chunks is not None:
+        da_in = da_in.chunk({'time': -1})
+    slots = gu.get_mask_slots(da_in.time, nslot)
+    years = da_in.time.dt.year.values
+    scr, amp, clim = xr.apply_ufunc(_scr_core, da_in, 
+                                    kwargs={'slots': slots, 'years': years, 'nslot': nslot},
+                                    input_core_dims=[['time']], 
+                                    output_core_dims=[[], [], ['slot']],
+                                    dask='parallelized', output_dtypes=[float]*3,
+                                    dask_gufunc_kwargs={'output_sizes': {'slot': nslot}})
+    ds_out = xr.Dataset({'SCR': scr, 'amplitude': amp, 
+                         'clim': clim.assign_coords(slot=np.arange(1, nslot+1))})
+    ds_out.attrs['years'] = f"{years.min()}-{years.max()}"
+    return ds_out
+
+################################################### 
+#
+# Gridpoint-vectorized Mann-Kendall trend tests
+# (same statistics as pymannkendall, for every 
+#  gridpoint of a (time, lat, lon) array at once)
+# 
+################################################### 
+
+MK_TESTS = {0: 'original', 1: 'hamed_rao', 2: 'yue_wang'}
+MK_STATS = ['slope', 'intercept', 's', 'var_s', 'z', 'p', 'tau', 'trend']
+# memory used for the pairwise slopes of one batch of gridpoints
+MK_SENS_BATCHBYTES = 64 * 1024**2
+
+def _nanmedian_rows(a):
+    '''
+    median along the last axis ignoring NaNs, without
+    the per-row python loop of np.nanmedian
+    '''
+    a = np.sort(a, axis=-1)
+    m = (~np.isnan(a)).sum(axis=-1)
+    lo = np.take_along_axis(a, np.maximum((m - 1) // 2, 0)[..., None], axis=-1)[..., 0]
+    hi = np.take_along_axis(a, np.maximum(m // 2, 0)[..., None], axis=-1)[..., 0]
+    med = 0.5 * (lo + hi)
+    med[m == 0] = np.nan
+    return med
+
+def _sens_slope_rows(x):
+    '''
+    Theil-Sen slope and Conover intercept of each row of x (npts, nt)
+    NaNs are skipped, pairwise slopes are built in batches of rows
+    '''
+    npts, nt = x.shape
+    i, j = np.triu_indices(nt, 1)
+    dt = (j - i).astype(float)
+    nbatch = max(1, MK_SENS_BATCHBYTES // max(8 * i.size, 1))
+    slope = np.full(npts, np.nan)
+    for b1 in range(0, npts, nbatch):
+        xb = x[b1:b1+nbatch]
+        slope[b1:b1+nbatch] = _nanmedian_rows((xb[:, j] - xb[:, i]) / dt)
+    tind = np.where(np.isnan(x), np.nan, np.arange(nt, dtype=float))
+    intercept = _nanmedian_rows(x) - _nanmedian_rows(tind) * slope
+    return slope, intercept
+
+def _mk_score_rows(x):
+    '''
+    Mann-Kendall S and its tie-corrected variance for rows of x (npts, n) 
+    '''
+    npts, n = x.shape
+    s = np.zeros(npts)
+    for k in range(n - 1):
+        s += np.sign(x[:, k+1:] - x[:, k:k+1]).sum(axis=1)
+    
+    # tie groups: runs of equal values in each sorted row
+    xs = np.sort(x, axis=1)
+    newgroup = np.ones(xs.shape, dtype=bool)
+    newgroup[:, 1:] = xs[:, 1:] != xs[:, :-1]
+    groupid = np.cumsum(newgroup.ravel()) - 1
+    tp = np.bincount(groupid).astype(float)
+    grouprow = np.repeat(np.arange(npts), newgroup.sum(axis=1))
+    ties = np.bincount(grouprow, weights=tp * (tp - 1) * (2 * tp + 5), minlength=npts)
+    var_s = (n * (n - 1) * (2 * n + 5) - ties) / 18
+    return s, var_s
+
+def _acf_rows(x):
+    '''
+    autocorrelation of each row of x (npts, n) at lags 0 to n-1
+    '''
+    n = x.shape[1]
+    y = x - x.mean(axis=1, keepdims=True)
+    f = np.fft.rfft(y, 2 * n, axis=1)
+    acov = np.fft.irfft(f * np.conj(f), 2 * n, axis=1)[:, :n] / n
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return acov / acov[:, :1]
+
+def _mk_test_rows(x, slope, testnum, alpha):
+    '''
+    Mann-Kendall test for rows of x (npts, n) without NaNs, 
+    slope (Sen's slope of the full series) detrends the corrected tests
+    returns s, var_s, tau, z
+    '''
+    from scipy import stats
+    n = x.shape[1]
+    s, var_s = _mk_score_rows(x)
+    tau = s / (.5 * n * (n - 1))
+    if testnum in [1, 2]:
+        x_detrend = x - np.arange(1, n+1) * slope[:, None]
+        lags = np.arange(1, n)
+    if testnum == 1:
+        # Hamed and Rao (1998): significant autocorrelation of ranks
+        acf = _acf_rows(stats.rankdata(x_detrend, axis=1))[:, 1:]
+        bound = stats.norm.ppf(1 - alpha / 2) / np.sqrt(n)
+        inside = (acf <= bound) & (acf >= -bound)
+        sni = np.where(inside, 0, (n-lags) * (n-lags-1) * (n-lags-2) * acf).sum(axis=1)
+        var_s = var_s * (1 + (2 / (n * (n-1) * (n-2))) * sni)
+    elif testnum == 2:
+        # Yue and Wang (2004): effective sample size
+        acf = _acf_rows(x_detrend)[:, 1:]
+        var_s = var_s * (1 + 2 * np.sum((1 - lags / n) * acf, axis=1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = np.where(s > 0, (s - 1) / np.sqrt(var_s), 0)
+        z = np.where(s < 0, (s + 1) / np.sqrt(var_s), z)
+    return s, var_s, tau, z
+
+def _mk_trend_core(x_in, testnum=0, alpha=0.05):
+    '''
+    Mann-Kendall statistics along the last axis of x_in
+    returns one array per MK_STATS entry with the leading shape of x_in
+    '''
+    from scipy import stats
+    shape = x_in.shape[:-1]
+    x = np.asarray(x_in, dtype=float).reshape(-1, x_in.shape[-1])
+    out = {key: np.full(x.shape[0], np.nan) for key in MK_STATS}
+    out['slope'], out['intercept'] = _sens_slope_rows(x)
+    
+    # NaNs are skipped: rows with the same number of valid values
+    # are packed (keeping time order) and tested together
+    valid = ~np.isnan(x)
+    nvalid = valid.sum(axis=1)
+    for n in np.unique(nvalid):
+        if n < 3: 
+            continue
+        rows = np.where(nvalid == n)[0]
+        order = np.argsort(~valid[rows], axis=1, kind='stable')[:, :n]
+        xpack = np.take_along_axis(x[rows], order, axis=1)
+        out['s'][rows], out['var_s'][rows], out['tau'][rows], out['z'][rows] = \
+            _mk_test_rows(xpack, out['slope'][rows], testnum, alpha)
+    out['p'] = 2 * (1 - stats.norm.cdf(np.abs(out['z'])))
+    h = np.abs(out['z']) > stats.norm.ppf(1 - alpha / 2)
+    out['trend'] = np.where(np.isnan(out['z']), np.nan, np.sign(out['z']) * h)
+    return tuple(out[key].reshape(shape) for key in MK_STATS)
+
+def get_trend_mk(da_in, testnum=0, alpha=0.05):
+    '''
+    Mann-Kendall trend test and Sen's slope at every gridpoint of da_in 
+    along time (or time_counter), lazily and chunk by chunk for dask input
+    testnum as in check_trend: 0 original test, 
+    1 Hamed-Rao and 2 Yue-Wang autocorrelation corrections.
+    returns Dataset of slope (per time step), intercept, s, var_s, 
+    z, p, tau and trend (1 increasing, -1 decreasing, 0 not significant)
+    '''
+    if testnum not in MK_TESTS:
+        return None
+    if not 'time' in da_in.dims:
+        da_in = da_in.rename({'time_counter':'time'})
+    if da_in.chunks is not None:
+        da_in = da_in.chunk({'time': -1})
+    stats_out = xr.apply_ufunc(_mk_trend_core, da_in, 
+                               kwargs={'testnum': testnum, 'alpha': alpha},
+                               input_core_dims=[['time']], 
+                               output_core_dims=[[] for key in MK_STATS],
+                               dask='parallelized', 
+                               output_dtypes=[float for key in MK_STATS])
+    ds_out = xr.Dataset(dict(zip(MK_STATS, stats_out)))
+    ds_out.attrs['test'] = MK_TESTS[testnum]
+    return ds_out
@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import time
+import argparse
+import dask
+from dask.callbacks import Callback
+import xarray as xr
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import bp12_tools.chpc_utils as cu
+import bp12_tools.grid_utils as gu
+import bp12_tools.model_utils as mu
+
+###################################################
+#
+# Contains a batch driver for extracting many
+# variables / years / reductions from the model
+# output on the cluster in parallel
+#
+# Python:  run_bp12batch(make_batch_tasks(...), outdir)
+# Shell:   python -m bp12_tools.batch_utils -h
+#
+###################################################
+
+BATCH_REDUCTIONS = ['surface', 'box', 'biome']
+BATCH_LEDGER = 'BIOPERIANT12_batch_ledger.jsonl'
+
+########## tasks ################
+
+def make_batch_tasks(varnames, zlevs, years, reductions):
+    '''
+    returns the list of tasks (dicts) for every combination of
+    variable, depth level, year and reduction
+    '''
+    tasks = []
+    for varname in varnames:
+        for zlev in zlevs:
+            for yr in years:
+                for reduction in reductions:
+                    tasks.append({'varname': varname, 'zlev': int(zlev),
+                                  'year': int(yr), 'reduction': reduction})
+    return tasks
+
+def get_task_id(task):
+    '''
+    unique name of a task, also used for its output file
+    '''
+    return f"{task['varname']}_z{task['zlev']}_{task['reduction']}_y{task['year']}"
+
+def get_task_outfile(task, outdir):
+    return f"{outdir}/BIOPERIANT12_{get_task_id(task)}.nc"
+
+def group_batch_tasks(tasks):
+    '''
+    group tasks by (file type, year) so each group of
+    files is opened once for all variables read from it
+    '''
+    groups = defaultdict(list)
+    for task in tasks:
+        ftype = mu.get_filetype(task['varname'])
+        if ftype and (task['reduction'] in BATCH_REDUCTIONS):
+            groups[(ftype, task['year'])].append(task)
+    return dict(groups)
+
+########## ledger ################
+
+def read_ledger(ledgerfile):
+    '''
+    returns the ids of tasks recorded as completed
+    '''
+    done = set()
+    if not os.path.exists(ledgerfile):
+        return done
+    with open(ledgerfile) as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)['task'])
+            except (ValueError, KeyError):
+                # partial line from an interrupted write
+                continue
+    return done
+
+def append_ledger(ledgerfile, records):
+    with open(ledgerfile, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+########## reductions ################
+
+def reduce_bp12var(var, reduction, yxinds=None, biome_in=None, gridarea=None):
+    '''
+    lazy reduction of a variable read with get_bp12var
+    surface: the field itself (zlev selects the level)
+    box:     subset yxinds=(j1, j2, i1, i2) of the sorted grid
+    biome:   area weighted stats per biome of biome_in
+    '''
+    if reduction == 'surface':
+        return var.to_dataset(name=var.name)
+    if reduction == 'box':
+        j1, j2, i1, i2 = yxinds
+        return var.isel(lat=slice(j1,j2), lon=slice(i1,i2)).to_dataset(name=var.name)
+    if reduction == 'biome':
+        return gu.get_biome_stats(var, biome_in, gridarea)
+    return None
+
+class _WriteTimer(Callback):
+    '''
+    records when each delayed write of a batch group has finished
+    '''
+    def __init__(self, keys):
+        super().__init__()
+        self.keys, self.finished = set(keys), {}
+
+    def _posttask(self, key, result, dsk, state, id):
+        if key in self.keys:
+            self.finished[key] = time.time()
+
+def run_batch_group(tasks, outdir, yxinds=None, biomefile=None, biomevar='biome'):
+    '''
+    run all tasks of one (file type, year) group: files are opened
+    once and all outputs are written in a single dask pass over the 
+    data, streamed to one file per task, then the group's datasets are closed.
+    Biome stats need a single level, tasks with zlev < 0 are skipped.
+    returns a ledger record per task with its throughput, timed from 
+    the start of its setup to the end of its write
+    '''
+    biome_in, gridarea = None, None
+    if any(task['reduction'] == 'biome' for task in tasks):
+        biome_in = xr.open_dataset(biomefile)[biomevar]
+        gridarea = mu.get_weightmodel(is_sorted=1)
+
+    writes, nbytes, setup, done = [], [], [], []
+    for task in tasks:
+        t0 = time.time()
+        if (task['reduction'] == 'biome') and (task['zlev'] < 0):
+            print(f"{get_task_id(task)}: skipped, biome stats need zlev >= 0")
+            continue
+        if task['reduction'] == 'box':
+            var = cu.get_bp12var_subset(task['varname'], f"y{task['year']}",
+                                        task['zlev'], yxinds)
+        else:
+            var = cu.get_bp12var(task['varname'], f"y{task['year']}", task['zlev'])
+        if var is None:
+            continue
+        var.name = task['varname']
+        if task['reduction'] == 'box':
+            ds_out = var.to_dataset(name=task['varname'])
+        else:
+            ds_out = reduce_bp12var(var, task['reduction'], yxinds, biome_in, gridarea)
+        writes.append(ds_out.to_netcdf(get_task_outfile(task, outdir), compute=False))
+        nbytes.append(var.nbytes)
+        setup.append(time.time() - t0)
+        done.append(task)
+
+    timer = _WriteTimer([write.key for write in writes])
+    t0 = time.time()
+    with timer:
+        dask.compute(*writes)
+    cu.clear_bp12cache(mu.get_filetype(tasks[0]['varname']), f"y{tasks[0]['year']}")
+
+    records = []
+    for task, write, nbyte, tsetup in zip(done, writes, nbytes, setup):
+        seconds = tsetup + timer.finished.get(write.key, time.time()) - t0
+        records.append(dict(task, task=get_task_id(task), seconds=round(seconds, 2),
+                            mbytes=round(nbyte / 1e6, 1),
+                            mbps=round(nbyte / 1e6 / max(seconds, 1e-6), 1)))
+    return records
+
+########## driver ################
+
+def run_bp12batch(tasks, outdir, nworkers=4, executor=None,
+                  yxinds=None, biomefile=None, biomevar='biome', resume=True):
+    '''
+    Run extraction tasks (see make_batch_tasks) in parallel,
+    one (file type, year) group per worker.
+    executor: a process-based concurrent.futures executor (e.g. a
+              ProcessPoolExecutor or mpi4py MPIPoolExecutor) whose workers
+              run cu.init_bp12worker; default is cu.get_bp12pool(nworkers). 
+              Groups share the module-level dataset and mesh caches of 
+              their worker, which are not thread safe, so thread pools 
+              are refused.
+    Completed tasks are appended to a ledger in outdir, with resume
+    tasks already in the ledger are skipped after a crash/restart.
+    returns the ledger records of the tasks run
+    '''
+    if isinstance(executor, ThreadPoolExecutor):
+        raise ValueError('run_bp12batch needs a process-based executor, '
+                         'the dataset and mesh caches are not thread safe')
+    os.makedirs(outdir, exist_ok=True)
+    ledgerfile = f"{outdir}/{BATCH_LEDGER}"
+    done = read_ledger(ledgerfile) if resume else set()
+    tasks = [task for task in tasks if get_task_id(task) not in done]
+    groups = group_batch_tasks(tasks)
+    if not groups:
+        return []
+
+    own_executor = executor is None
+    if own_executor:
+        executor = cu.get_bp12pool(nworkers)
+    else:
+        # workers only read the index, build it before they start
+        cu.update_bp12index()
+    records = []
+    try:
+        futures = {executor.submit(run_batch_group, grouptasks, outdir,
+                                   yxinds, biomefile, biomevar): key
+                   for key, grouptasks in groups.items()}
+        for future in as_completed(futures):
+            ftype, yr = futures[future]
+            try:
+                grouprecords = future.result()
+            except Exception as err:
+                print(f"{ftype} {yr}: failed ({err})")
+                continue
+            append_ledger(ledgerfile, grouprecords)
+            for record in grouprecords:
+                print(f"{record['task']}: {record['mbytes']} MB in "
+                      f"{record['seconds']} s ({record['mbps']} MB/s)")
+            records.extend(grouprecords)
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return records
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Parallel extraction of BIOPERIANT12 variables')
+    parser.add_argument('--vars', nargs='+', required=True)
+    parser.add_argument('--zlev', nargs='+', type=int, default=[0],
+                        help='depth levels, -1 for the whole water column')
+    parser.add_argument('--years', nargs=2, type=int, required=True, metavar=('Y1', 'Y2'))
+    parser.add_argument('--reductions', nargs='+', default=['surface'], choices=BATCH_REDUCTIONS)
+    parser.add_argument('--outdir', required=True)
+    parser.add_argument('--nworkers', type=int, default=4)
+    parser.add_argument('--box', nargs=4, type=int, metavar=('J1', 'J2', 'I1', 'I2'))
+    parser.add_argument('--biomefile')
+    parser.add_argument('--biomevar', default='biome')
+    parser.add_argument('--no-resume', action='store_true')
+    args = parser.parse_args(argv)
+    if ('box' in args.reductions) and (args.box is None):
+        parser.error('box reduction needs --box')
+    if ('biome' in args.reductions) and (args.biomefile is None):
+        parser.error('biome reduction needs --biomefile')
+    if ('biome' in args.reductions) and (min(args.zlev) < 0):
+        parser.error('biome reduction needs depth levels >= 0')
+
+    years = range(args.years[0], args.years[1]+1)
+    tasks = make_batch_tasks(args.vars, args.zlev, years, args.reductions)
+    run_bp12batch(tasks, args.outdir, args.nworkers, yxinds=args.box,
+                  biomefile=args.biomefile, biomevar=args.biomevar,
+                  resume=not args.no_resume)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,91 +1,341 @@
-import pandas as pd
 import numpy as np
 import xarray as xr
 import re
 import os
+import sqlite3
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import bp12_tools.model_utils as mu
+import bp12_tools.grid_utils as gu
 #
 # Contains functions for reading data from chpc cluster
 # Option "is_sorted" returns data on a cleaned lat lon gris
 # else returns on original model grid
 #
 
-def get_bp12filenames(ftype, filedates):
+BP12_INDIR = '/mnt/nrestore/users/ERTH0834/BIOPERIANT12/BIOPERIANT12-CNCLNG01-S'
+BP12_INDEXFILE = os.path.join(os.path.expanduser('~'), '.bp12_tools', 'BIOPERIANT12_fileindex.sqlite')
+BP12_FILE_RE = re.compile(r"BIOPERIANT12-CNCLNG01_y(?P<yr>\d{4})m(?P<mm>\d{2})d(?P<dd>\d{2})_(?P<ftype>\w+)\.nc$")
+
+# in-memory copies of the file index, one per (indir, indexfile)
+_BP12_INDEX = {}
+# pool workers read the index built by the parent without scanning or writing
+_BP12_INDEX_READONLY = False
+
+# limits for the cache of opened multi-file datasets
+BP12_CACHE_MAXFILES = 1024
+BP12_CACHE_MAXBYTES = 2 * 1024**3
+_BP12_DSCACHE = OrderedDict()
+
+# target size of one dask chunk and the on-disk layout per (ftype, varname)
+BP12_CHUNKMEM = 128 * 1024**2
+_BP12_LAYOUT = {}
+
+# variables summed from several model outputs
+BP12_VARSUMS = {'pp': ['PPPHY', 'PPPHY2'], 'chl': ['NCHL', 'DCHL']}
+
+########## file index ################
+
+def update_bp12index(indir=None, indexfile=None, rescan=False):
     '''
-    for use on cluster, returns 2 lists:
-    list 1. full path to each file for the required dates
-    list 2. pandas timestamps to overwrite model dates
+    Scans the model output tree (default BP12_INDIR) into a small 
+    sqlite table in indexfile (default BP12_INDEXFILE)
+    (file type x date -> path, size, mtime).
+    Only year directories that are new or whose mtime changed since 
+    the last scan are re-read, unless rescan is set.
+    Returns the number of year directories scanned.
+    '''
+    indir = BP12_INDIR if indir is None else indir
+    indexfile = BP12_INDEXFILE if indexfile is None else indexfile
+    Path(indexfile).parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(indexfile)
+    con.execute("CREATE TABLE IF NOT EXISTS years (indir TEXT, year INTEGER, mtime REAL, "
+                "PRIMARY KEY (indir, year))")
+    con.execute("CREATE TABLE IF NOT EXISTS files (indir TEXT, ftype TEXT, year INTEGER, "
+                "month INTEGER, day INTEGER, path TEXT, size INTEGER, mtime REAL, "
+                "PRIMARY KEY (indir, ftype, year, month, day))")
+    scanned = dict(con.execute("SELECT year, mtime FROM years WHERE indir=?", (indir,)))
+
+    nscan = 0
+    for ydir in os.scandir(indir):
+        if not (ydir.name.isdigit() and ydir.is_dir()):
+            continue
+        yr, ymtime = int(ydir.name), ydir.stat().st_mtime
+        if (not rescan) and (scanned.get(yr) == ymtime):
+            continue
+        rows = []
+        for entry in os.scandir(ydir.path):
+            m = BP12_FILE_RE.match(entry.name)
+            if m:
+                st = entry.stat()
+                rows.append((indir, m['ftype'], int(m['yr']), int(m['mm']), int(m['dd']), 
+                             entry.path, st.st_size, st.st_mtime))
+        with con:
+            con.execute("DELETE FROM files WHERE indir=? AND year=?", (indir, yr))
+            con.executemany("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?)", rows)
+            con.execute("INSERT OR REPLACE INTO years VALUES (?,?,?)", (indir, yr, ymtime))
+        nscan += 1
+    con.close()
+    return nscan
+
+def get_bp12index(indir=None, indexfile=None, refresh=False):
+    '''
+    returns the file index as a dict keyed on 
+    (ftype, yr), (ftype, yr, mm) and (ftype, yr, mm, dd)
+    each holding a date-ordered list of (path, (yr, mm, dd)).
+    The on-disk index is updated on first use in a process,
+    use refresh=True to pick up years added since. Workers of 
+    get_bp12pool only read the index the parent has built.
+    '''
+    indir = BP12_INDIR if indir is None else indir
+    indexfile = BP12_INDEXFILE if indexfile is None else indexfile
+    key = (indir, indexfile)
+    if refresh or (key not in _BP12_INDEX):
+        if _BP12_INDEX_READONLY:
+            # no writers during a pool run, skip sqlite locking (unreliable on NFS)
+            con = sqlite3.connect(f"{Path(indexfile).resolve().as_uri()}?immutable=1", uri=True)
+        else:
+            update_bp12index(indir, indexfile)
+            con = sqlite3.connect(indexfile)
+        index = defaultdict(list)
+        rows = con.execute("SELECT ftype, year, month, day, path FROM files WHERE indir=? "
+                           "ORDER BY year, month, day", (indir,))
+        for ftype, yr, mm, dd, path in rows:
+            entry = (path, (yr, mm, dd))
+            index[(ftype, yr)].append(entry)
+            index[(ftype, yr, mm)].append(entry)
+            index[(ftype, yr, mm, dd)].append(entry)
+        con.close()
+        _BP12_INDEX[key] = dict(index)
+    return _BP12_INDEX[key]
+
+def init_bp12worker(indir, indexfile):
+    '''
+    pool worker initializer: use the parent's model directory 
+    and file index, read-only
+    '''
+    global BP12_INDIR, BP12_INDEXFILE, _BP12_INDEX_READONLY
+    BP12_INDIR, BP12_INDEXFILE, _BP12_INDEX_READONLY = indir, indexfile, True
+
+def get_bp12pool(nworkers):
+    '''
+    process pool for reading model output in parallel: the file index 
+    is brought up to date once here, before any worker starts, and 
+    workers only read it (init_bp12worker)
+    '''
+    update_bp12index()
+    return ProcessPoolExecutor(max_workers=nworkers, initializer=init_bp12worker,
+                               initargs=(BP12_INDIR, BP12_INDEXFILE))
+
+def parse_bp12dates(filedates):
+    '''
+    converts a date spec (y2004, 2004, ym200408, y2004m08d03)
+    to an index key (yr,), (yr, mm) or (yr, mm, dd)
     '''
-    indir = '/mnt/nrestore/users/ERTH0834/BIOPERIANT12/BIOPERIANT12-CNCLNG01-S'
     dates_alph = re.sub('[0-9]', '', filedates)
     dates_nums = re.sub(r'[^0-9]', '', filedates)
     if dates_alph == 'y':
-        yr = int(filedates.split('y')[1])
-        dates_model =  mu.get_mmdd_5d(yr)
+        return (int(dates_nums),)
     elif (not dates_alph) and (1988 < int(dates_nums) < 2010):
-        yr = int(dates_nums)
-        dates_model =  mu.get_mmdd_5d(yr)
-    elif dates_alph =='ym':
-        yr, mm = int(dates_nums[:4]), int(dates_nums[4:6])
-        dates_model = [datestr for datestr in mu.get_mmdd_5d(yr) if f"m{mm:02d}"in datestr]
-    elif dates_alph =='ymd':
-        yr = int(dates_nums[:4])
-        dates_model = [filedates]
-
-    filenames, ts = [], []
-    for dd in dates_model:
-        filename = f"{indir}/{yr}/BIOPERIANT12-CNCLNG01_{dd}_{ftype}.nc"
-        if os.path.isfile(filename):
-            filenames.append(filename)  
-            ts.append(pd.Timestamp(int(dd[1:5]), int(dd[6:8]), int(dd[9:11]) ,12))
+        return (int(dates_nums),)
+    elif dates_alph == 'ym':
+        return (int(dates_nums[:4]), int(dates_nums[4:6]))
+    elif dates_alph == 'ymd':
+        return (int(dates_nums[:4]), int(dates_nums[4:6]), int(dates_nums[6:8]))
+    return None
+
+def get_bp12filenames(ftype, filedates):
+    '''
+    for use on cluster, returns 2 lists:
+    list 1. full path to each file for the required dates
+    list 2. datetime64 dates (mu.BP12_CAL5D) to overwrite model dates
+    Files are looked up in the file index rather than on disk.
+    '''
+    datekey = parse_bp12dates(filedates)
+    if not datekey:
+        return [], []
+    entries = get_bp12index().get((ftype,) + datekey, [])
+    filenames = [path for path, _ in entries]
+    ymd = np.array([date for _, date in entries], dtype=int).reshape(-1, 3)
+    ts = mu.BP12_CAL5D.to_datetime(ymd[:, 0], ymd[:, 1], ymd[:, 2])
     return filenames, ts
 
-def get_bp12var(varname, vardates, zlev):
+########## dataset cache ################
+
+def _get_ds_nbytes(ds):
     '''
-    returns variable on sorted grid with correct timestamps
-    if zlev < 0 will return whole water column
+    bytes a dataset holds in memory: loaded variables, coordinates 
+    and indexes. Lazy (dask) variables only hold file handles, 
+    bounded by BP12_CACHE_MAXFILES
     '''
-    ftype = get_filetype(varname)
-    if not ftype: 
-        return None
+    return sum(var.nbytes for var in ds.variables.values() if var.chunks is None)
+
+def _evict_bp12cache():
+    '''
+    close least recently used datasets until the cache is 
+    within the open-file and memory limits
+    '''
+    while len(_BP12_DSCACHE) > 1:
+        nfiles = sum(entry[1] for entry in _BP12_DSCACHE.values())
+        nbytes = sum(entry[2] for entry in _BP12_DSCACHE.values())
+        if (nfiles <= BP12_CACHE_MAXFILES) and (nbytes <= BP12_CACHE_MAXBYTES):
+            break
+        _, (ds, _, _) = _BP12_DSCACHE.popitem(last=False)
+        ds.close()
+
+def clear_bp12cache(ftype=None, vardates=None):
+    '''
+    close and forget cached model datasets, all of them or only 
+    those of one file type and/or dates
+    '''
+    keys = [key for key in _BP12_DSCACHE 
+            if (ftype in [None, key[0]]) and (vardates in [None, key[1]])]
+    for key in keys:
+        ds, _, _ = _BP12_DSCACHE.pop(key)
+        ds.close()
+
+def get_bp12ds(ftype, vardates):
+    '''
+    returns all files of one type for the dates as a single dataset 
+    on the sorted grid (time, [deptht], lat, lon) with correct timestamps,
+    chunked as on disk (one file per time chunk).
+    Datasets are kept open in a process-level LRU cache keyed on 
+    (ftype, vardates) so all variables, levels and layouts of a file type 
+    are read from one open; get_bp12var rechunks each variable.
+    '''
+    key = (ftype, vardates)
+    if key in _BP12_DSCACHE:
+        _BP12_DSCACHE.move_to_end(key)
+        return _BP12_DSCACHE[key][0]
 
     filenames, ts = get_bp12filenames(ftype, vardates)
-    ds = xr.open_mfdataset(filenames, decode_times=False, 
-                           chunks={'y': 561, 'x': 1080},
+    if not filenames:
+        return None
+    ds = xr.open_mfdataset(filenames, decode_times=False, chunks={},
                            concat_dim='time_counter', combine='nested')
     ds['time_counter'] = ts[:]  
-    
-    # read variable
-    if varname in ['pp','PP']: 
-        var = ds['PPPHY'] + ds['PPPHY2']
-    elif varname in ['chl','CHL']: 
-        var = ds['NCHL'] + ds['DCHL']
-    else:       
-        var = ds[varname]
-        
-    if 'depthu' in var.dims:
-        var = var.rename({'depthu':'deptht'})
-    if 'depthv' in var.dims:
-        var = var.rename({'depthv':'deptht'})
-    if 'depthw' in var.dims:
-        var = var.rename({'depthw':'deptht'})
+    for depthname in ['depthu', 'depthv', 'depthw']:
+        if depthname in ds.dims:
+            ds = ds.rename({depthname:'deptht'})
         
     # now sort
-    var = var.rename({'y':'lat', 'x':'lon','time_counter':'time'})
-    var = var.assign_coords(lat=("lat", ds.nav_lat[0,:,0].values), 
-                            lon=("lon", ds.nav_lon[0,0,:].values))
-    var = var.sortby('lon').drop_duplicates('lon', keep='first') 
+    ds = ds.rename({'time_counter':'time'})
+    ds = gu.sort_bp12var(ds)
+
+    _BP12_DSCACHE[key] = (ds, len(filenames), _get_ds_nbytes(ds))
+    _evict_bp12cache()
+    return ds
+
+########## chunking ################
+
+def get_bp12layout(ftype, varname, filename):
+    '''
+    returns the on-disk layout of a variable from one model file:
+    shape (nz, ny, nx), itemsize and the (y, x) size of one disk chunk.
+    Contiguous variables are read efficiently in whole rows, 
+    compressed ones only in whole chunks.
+    '''
+    key = (ftype, varname)
+    if key not in _BP12_LAYOUT:
+        with xr.open_dataset(filename, decode_times=False) as ds:
+            var = ds[BP12_VARSUMS.get(varname.lower(), [varname])[0]]
+            sizes = dict(var.sizes)
+            nz = [size for dim, size in sizes.items() if dim.startswith('depth')]
+            nz = nz[0] if nz else 1
+            ny, nx = sizes['y'], sizes['x']
+            diskchunks = var.encoding.get('chunksizes')
+            if diskchunks:
+                diskchunks = dict(zip(var.dims, diskchunks))
+                diskchunks = (diskchunks['y'], diskchunks['x'])
+            else:
+                diskchunks = (1, nx)
+            _BP12_LAYOUT[key] = ((nz, ny, nx), var.dtype.itemsize, diskchunks)
+    return _BP12_LAYOUT[key]
+
+def get_bp12chunks(shape, itemsize, diskchunks, layout='ts', chunkmem=BP12_CHUNKMEM):
+    '''
+    dask chunks (time, deptht, lat, lon) for a (nt, nz, ny, nx) variable
+    layout 'ts':  full time series in each chunk (time-contiguous pencils),
+                  for trends, climatologies and other reductions over time
+    layout 'map': one time step (one file) per chunk over the whole 
+                  domain or large spatial tiles, for maps and spatial reductions
+    Spatial tiles are multiples of the disk chunks and sized so a chunk
+    stays within chunkmem bytes, the depth axis is kept whole when it fits.
+    '''
+    nt, nz, ny, nx = shape
+    dy, dx = diskchunks
+    ct = 1 if layout == 'map' else nt
+    cz = nz if (ct * nz * dy * dx * itemsize <= chunkmem) else 1
+    
+    # largest tile of whole disk chunks within budget, with the grid's aspect
+    npts = max(chunkmem // (itemsize * ct * cz), dy * dx)
+    cx = min(nx, max(dx, int(np.sqrt(npts * nx / ny)) // dx * dx))
+    cy = min(ny, max(dy, (npts // cx) // dy * dy))
+    return {'time': ct, 'deptht': cz, 'lat': cy, 'lon': cx}
+
+########## model output ################
+
+def select_bp12var(ds, varname):
+    '''
+    returns variable from an opened model dataset, 
+    summing the components of total pp and chl
+    '''
+    parts = BP12_VARSUMS.get(varname.lower())
+    if parts: 
+        return sum([ds[part] for part in parts[1:]], ds[parts[0]])
+    return ds[varname]
+
+def get_bp12var(varname, vardates, zlev, layout='ts', chunkmem=BP12_CHUNKMEM):
+    '''
+    returns variable on sorted grid with correct timestamps
+    if zlev < 0 will return whole water column
+    Chunks follow the on-disk layout and the intended use 
+    (layout 'ts' or 'map', see get_bp12chunks) within chunkmem bytes.
+    '''
+    ftype = mu.get_filetype(varname)
+    if not ftype: 
+        return None
+    filenames, _ = get_bp12filenames(ftype, vardates)
+    if not filenames:
+        return None
+
+    (nz, ny, nx), itemsize, diskchunks = get_bp12layout(ftype, varname, filenames[0])
+    if zlev >= 0: 
+        nz = 1
+    chunks = get_bp12chunks((len(filenames), nz, ny, nx), itemsize, diskchunks, 
+                            layout, chunkmem)
+    ds = get_bp12ds(ftype, vardates)
+    var = select_bp12var(ds, varname)
     
     # Prep clean dataset for return
-    if (zlev >= 0) or (var.ndim == 3):
-        if var.ndim > 3: var = var.isel(deptht=zlev)  
-        var = var.chunk(chunks={"time":var.time.size, "lat":561, "lon":1080})
-        return var
-    else:
-        var = var.chunk(chunks={"time":var.time.size, 
-                                "deptht":var.deptht.size, "lat":561,"lon":1080})
-        return var
+    if (zlev >= 0) and ('deptht' in var.dims):
+        var = var.isel(deptht=zlev)  
+    return var.chunk({dim: chunks[dim] for dim in var.dims})
+
+def get_bp12vars(varnames, vardates, zlev):
+    '''
+    returns a dataset with several variables on sorted grid, 
+    files are opened once per file type
+    '''
+    varsout = {}
+    for varname in varnames:
+        var = get_bp12var(varname, vardates, zlev)
+        if var is not None:
+            varsout[varname] = var
+    return xr.Dataset(varsout)
+    
+def iter_bp12var(varname, vardates, zlev):
+    '''
+    yields the time slices of a variable on sorted grid, loaded 
+    one 5-day file at a time so only one slice is held in memory
+    if zlev < 0 slices hold the whole water column
+    '''
+    var = get_bp12var(varname, vardates, zlev, layout='map')
+    if var is None:
+        return
+    for it in range(var.time.size):
+        yield var.isel(time=it).load()
     
 def get_bp12var_subset(varname, vardates, zlev, yxinds):
     '''
@@ -93,6 +343,8 @@ def get_bp12var_subset(varname, vardates, zlev, yxinds):
     '''
     j1, j2, i1, i2 = yxinds
     varout = get_bp12var(varname, vardates, zlev)
+    if varout is None:
+        return None
     return varout.isel(lat=slice(j1,j2), lon=slice(i1,i2))
     
 
@@ -105,11 +357,6 @@ def get_bp12input(varname, filename, is_sorted=1):
     var = ds_in[varname]
     
     if is_sorted == 1:
-        if "z" in var.dims: var = var.rename({'z':'deptht'})
-        if "x" in var.dims:
-            ds_in = ds_in.rename({'x':'lon', 'y':'lat'})
-            ds_in = ds_in.assign_coords( lat=("lat", ds_in.nav_lat[:,0].values), 
-                                     lon=("lon", ds_in.nav_lon[0,:].values ))
-            var = ds_in[varname].sortby('lon').drop_duplicates('lon', keep='first')
+        var = gu.sort_bp12var(var)
        
-    return var
\ No newline at end of file
+    return var
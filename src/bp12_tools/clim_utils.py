@@ -0,0 +1,151 @@
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+import bp12_tools.chpc_utils as cu
+import bp12_tools.grid_utils as gu
+import bp12_tools.model_utils as mu
+import bp12_tools.analysis_utils as au
+
+################################################### 
+#
+# Contains functions for building climatologies 
+# from 5-day model output, streamed year by year
+# 
+################################################### 
+
+CLIM_NSLOTS = {'month': 12, 'season': 4, '5d': 73}
+# file name suffixes used by the existing outputs (_clim_monthly.nc, _IA_5d.nc)
+CLIM_SUFFIXES = {'month': 'monthly', 'season': 'seasonal', '5d': '5d'}
+
+def get_clim_slots(var_time, freq='month'):
+    '''
+    returns the climatology slot of each timestamp
+    month: 0-11, season: 0-3 (DJF, MAM, JJA, SON), 5d: 0-72
+    '''
+    if freq == 'season':
+        return mu.BP12_CAL5D.get_seasons(var_time)
+    return gu.get_mask_slots(var_time, CLIM_NSLOTS[freq])
+
+def make_accumulator(nslot, shape):
+    '''
+    running count, mean and sum of squared deviations 
+    per slot and gridpoint
+    '''
+    return {'count': np.zeros((nslot,) + shape, dtype=np.int32),
+            'mean': np.zeros((nslot,) + shape), 
+            'm2': np.zeros((nslot,) + shape)}
+
+def update_accumulator(acc, slot, values):
+    '''
+    add one time slice to its slot with Welford's update,
+    NaN gridpoints are skipped
+    '''
+    valid = ~np.isnan(values)
+    count = acc['count'][slot] + valid
+    delta = np.where(valid, values - acc['mean'][slot], 0)
+    acc['mean'][slot] += delta / np.maximum(count, 1)
+    acc['m2'][slot] += np.where(valid, delta * (values - acc['mean'][slot]), 0)
+    acc['count'][slot] = count
+
+def merge_accumulator(acc, acc_other):
+    '''
+    combine two accumulators of the same shape (e.g. from 
+    different years or workers) with Chan's parallel update
+    '''
+    count = acc['count'] + acc_other['count']
+    delta = acc_other['mean'] - acc['mean']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.where(count > 0, acc_other['count'] / count, 0)
+    acc['m2'] += acc_other['m2'] + delta**2 * acc['count'] * frac
+    acc['mean'] += delta * frac
+    acc['count'] = count
+    return acc
+
+def get_accumulator_stats(acc, ddof=1):
+    '''
+    returns mean, std and count per slot, NaN where no data
+    '''
+    count = acc['count']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, acc['mean'], np.nan)
+        std = np.where(count > ddof, np.sqrt(acc['m2'] / (count - ddof)), np.nan)
+    return mean, std, count
+
+def _make_clim_ds(acc, dims, coords, timecoord, varname):
+    '''
+    wrap accumulator statistics into a dataset
+    '''
+    mean, std, count = get_accumulator_stats(acc)
+    dims = ('time',) + dims
+    return xr.Dataset(
+        data_vars={varname: (dims, mean),
+                   f"{varname}_std": (dims, std),
+                   f"{varname}_count": (dims, count)},
+        coords=dict(coords, time=timecoord))
+
+def make_bp12clim(varname, y1, y2, zlev, outprefix, freq='month'):
+    '''
+    Stream 5-day files of a variable one time slice at a time over 
+    the years y1-y2 and write
+    {outprefix}_clim_{suffix}.nc : climatological mean, std and count 
+                                   per month/season/5-day slot,
+                                   suffix monthly/seasonal/5d (CLIM_SUFFIXES)
+    {outprefix}_IA_monthly.nc    : monthly mean, std and count of each year
+    Memory is bounded by the accumulators (one field per slot) 
+    and a single time slice, whatever the number of years.
+    '''
+    nslot = CLIM_NSLOTS[freq]
+    clim_acc, yearfiles = None, []
+    for yr in range(int(y1), int(y2)+1):
+        ia_acc = None
+        for var in cu.iter_bp12var(varname, f"y{yr}", zlev):
+            if clim_acc is None:
+                dims = var.dims
+                coords = {dim: var[dim].values for dim in dims if dim in var.coords}
+                clim_acc = make_accumulator(nslot, var.shape)
+            if ia_acc is None:
+                ia_acc = make_accumulator(12, var.shape)
+            values = var.values.astype(float)
+            update_accumulator(clim_acc, get_clim_slots(var.time.values, freq)[0], values)
+            update_accumulator(ia_acc, get_clim_slots(var.time.values, 'month')[0], values)
+        if ia_acc is None:
+            continue
+        
+        # one file per year keeps only the current year in memory
+        ia_time = [pd.Timestamp(yr, mo, 15) for mo in range(1, 13)]
+        yearfile = f"{outprefix}_IA_monthly_{yr}.nc"
+        _make_clim_ds(ia_acc, dims, coords, ia_time, varname).to_netcdf(yearfile)
+        yearfiles.append(yearfile)
+    if clim_acc is None:
+        return None
+    
+    climfile = f"{outprefix}_clim_{CLIM_SUFFIXES[freq]}.nc"
+    ds_clim = _make_clim_ds(clim_acc, dims, coords, np.arange(1, nslot+1), varname)
+    ds_clim.attrs['years'] = f"{y1}-{y2}"
+    ds_clim.to_netcdf(climfile)
+    
+    iafile = f"{outprefix}_IA_monthly.nc"
+    with xr.open_mfdataset(yearfiles, combine='by_coords') as ds_ia:
+        ds_ia.to_netcdf(iafile)
+    for yearfile in yearfiles:
+        os.remove(yearfile)
+    return climfile, iafile
+
+def make_bp12scr(varname, y1, y2, zlev, outfile, freq='month'):
+    '''
+    Seasonal cycle reproducibility and amplitude (au.get_scr) of a 
+    model variable over the years y1-y2 written to outfile,
+    cycles are monthly (freq='month') or 5-day (freq='5d').
+    Spatial tiles are sized so one tile holds all years 
+    within the default chunk memory budget.
+    '''
+    years = range(int(y1), int(y2)+1)
+    chunkmem = cu.BP12_CHUNKMEM // len(years)
+    varyrs = [cu.get_bp12var(varname, f"y{yr}", zlev, chunkmem=chunkmem) for yr in years]
+    varyrs = [var for var in varyrs if var is not None]
+    if not varyrs:
+        return None
+    ds_scr = au.get_scr(xr.concat(varyrs, dim='time'), CLIM_NSLOTS[freq])
+    ds_scr.to_netcdf(outfile)
+    return outfile
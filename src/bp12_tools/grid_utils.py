@@ -1,5 +1,6 @@
+import os
+import re
 import numpy as np
-from math import pi
 import xarray as xr
 
 ################################################### 
@@ -9,34 +10,253 @@ import xarray as xr
 # 
 ################################################### 
 
-def get_bp12grid(varname, is_sorted=1):
-    ''' 
-    returns variable from files in the data/GRID directory
-    with grid sorted option
+# grid directory, set BP12_GRIDDIR on the cluster where jobs do not run from notebooks/
+BP12_GRIDDIR = os.environ.get("BP12_GRIDDIR", "../data/GRID")
+BP12_MESHFILE = f"{BP12_GRIDDIR}/BIOPERIANT12_grid.nc"
+BP12_BATHYFILE = f"{BP12_GRIDDIR}/BIOPERIANT12_bathymetry.nc"
+BP12_MESHCACHE = f"{BP12_GRIDDIR}/.meshcache"
+
+# sorted grid descriptors, one per mesh file or nav_lon/nav_lat axes
+_BP12_SORTEDGRID = {}
+# memory-mapped mesh fields, one per (varname, is_sorted)
+_BP12_MESH = {}
+# obs cell areas, one per (lon, lat) axis pair
+_OBS_AREAGRID = {}
+# layer thickness within depth ranges, keyed on (zmin, zmax)
+_BP12_DEPTHWEIGHTS = {}
+
+########## sorted grid ################
+
+def get_index_runs(indices):
     '''
-    if varname in ["Bathymetry"]:
-        model_grid = xr.open_dataset(f"../data/GRID/BIOPERIANT12_bathymetry.nc")
-        var = model_grid[varname]
-    else:    
-        meshfile = f"../data/GRID/BIOPERIANT12_grid.nc"   
+    split an array of indices into slices of consecutive values
+    '''
+    breaks = np.where(np.diff(indices) != 1)[0] + 1
+    starts = np.r_[0, breaks]
+    stops = np.r_[breaks, indices.size]
+    return [slice(int(indices[i1]), int(indices[i2-1])+1) for i1, i2 in zip(starts, stops)]
+
+class BP12Grid:
+    '''
+    Descriptor of the sorted (lat, lon) model grid:
+    lon sort indices and the slices they reduce to, 
+    the mask of columns kept after dropping duplicate lons,
+    the 1d lat/lon/depth axes and the land-sea mask 
+    (number of wet levels per column, on the sorted grid).
+    Holds plain numpy arrays only so it pickles cheaply to workers.
+    '''
+    def __init__(self, nav_lon, nav_lat, depth=None, mbathy=None):
+        nav_lon, nav_lat = np.asarray(nav_lon), np.asarray(nav_lat)
+        self.lonsort = np.unique(nav_lon, return_index=True)[1]
+        self.lonslices = get_index_runs(self.lonsort)
+        self.lonkeep = np.zeros(nav_lon.size, dtype=bool)
+        self.lonkeep[self.lonsort] = True
+        self.lon = nav_lon[self.lonsort]
+        self.lat = nav_lat
+        self.depth = None if depth is None else np.asarray(depth)
+        self.mbathy = None if mbathy is None else np.asarray(mbathy)[:, self.lonsort]
+
+    def sort(self, var, dim='lon'):
+        '''
+        put a DataArray/Dataset with dimension dim (original x order)
+        on the sorted grid. The reorder is a roll plus trim, applied 
+        as a concatenation of contiguous slices; only if the sort does 
+        not reduce to a few slices is a general index used.
+        '''
+        if len(self.lonslices) == 1:
+            var = var.isel({dim: self.lonslices[0]})
+        elif len(self.lonslices) <= 4:
+            parts = [var.isel({dim: sl}) for sl in self.lonslices]
+            if isinstance(var, xr.Dataset):
+                var = xr.concat(parts, dim=dim, data_vars='minimal', 
+                                coords='minimal', compat='override')
+            else:
+                var = xr.concat(parts, dim=dim, coords='minimal', compat='override')
+        else:
+            var = var.isel({dim: self.lonsort})
+        if dim == 'lon':
+            var = var.assign_coords(lon=("lon", self.lon))
+        return var
+
+    def get_tmask(self, zlev=None):
+        '''
+        returns the sorted land-sea mask, 3d or at level zlev
+        '''
+        if zlev is not None:
+            mask = (self.mbathy > zlev).astype('int8')
+            return xr.DataArray(mask, dims=['lat', 'lon'], 
+                                coords={'lat': self.lat, 'lon': self.lon})
+        levels = np.arange(self.depth.size)[:, None, None]
+        mask = (levels < self.mbathy[None, :, :]).astype('int8')
+        return xr.DataArray(mask, dims=['deptht', 'lat', 'lon'],
+                            coords={'deptht': self.depth, 'lat': self.lat, 'lon': self.lon})
+
+    def save(self, filename):
+        '''
+        write descriptor to a .npz file
+        '''
+        np.savez(filename, lonsort=self.lonsort, lonkeep=self.lonkeep, lon=self.lon, 
+                 lat=self.lat, depth=self.depth, mbathy=self.mbathy)
+
+def load_sortedgrid(filename):
+    '''
+    read a descriptor written with BP12Grid.save
+    '''
+    npz = np.load(filename, allow_pickle=True)
+    grid = BP12Grid.__new__(BP12Grid)
+    grid.lonsort, grid.lon, grid.lat = npz['lonsort'], npz['lon'], npz['lat']
+    grid.lonkeep = npz['lonkeep']
+    grid.lonslices = get_index_runs(grid.lonsort)
+    grid.depth = None if npz['depth'].ndim == 0 else npz['depth']
+    grid.mbathy = None if npz['mbathy'].ndim == 0 else npz['mbathy']
+    return grid
+
+def get_sortedgrid(meshfile=BP12_MESHFILE):
+    '''
+    returns the sorted grid descriptor of the mesh file,
+    built once per process and again only if the file changes
+    '''
+    mtime = os.stat(meshfile).st_mtime_ns
+    if (meshfile not in _BP12_SORTEDGRID) or (_BP12_SORTEDGRID[meshfile][0] != mtime):
         model_grid = xr.open_dataset(meshfile, decode_times= False)
+        mbathy = model_grid.tmask[0].sum('z').values
+        grid = BP12Grid(model_grid.nav_lon[0,:].values, model_grid.nav_lat[:,0].values,
+                        model_grid.gdept_0[0,:].values, mbathy)
+        model_grid.close()
+        _BP12_SORTEDGRID[meshfile] = (mtime, grid)
+    return _BP12_SORTEDGRID[meshfile][1]
+
+def get_navgrid(var):
+    '''
+    sorted grid descriptor from the nav_lon/nav_lat of a model file
+    (T, U and V points each have their own), built once per distinct
+    axes. Needs no mesh file. Returns None without nav_lon.
+    '''
+    if 'nav_lon' not in var.coords and not (isinstance(var, xr.Dataset) and 'nav_lon' in var):
+        return None
+    nav_lon, nav_lat = var['nav_lon'], var['nav_lat']
+    nav_lon = nav_lon.isel({dim: 0 for dim in nav_lon.dims if dim != 'x'}).values
+    nav_lat = nav_lat.isel({dim: 0 for dim in nav_lat.dims if dim != 'y'}).values
+    key = ('nav', nav_lon.tobytes(), nav_lat.tobytes())
+    if key not in _BP12_SORTEDGRID:
+        _BP12_SORTEDGRID[key] = BP12Grid(nav_lon, nav_lat)
+    return _BP12_SORTEDGRID[key]
+
+def sort_bp12var(var, meshfile=None):
+    '''
+    put a DataArray/Dataset with model dims (y, x[, z]) on the 
+    sorted grid with lat/lon (and deptht) coordinates.
+    lat/lon come from the variable's own nav_lat/nav_lon if it has 
+    them (model output files), else from meshfile (default BP12_MESHFILE)
+    '''
+    grid = None if meshfile else get_navgrid(var)
+    if grid is None:
+        grid = get_sortedgrid(meshfile or BP12_MESHFILE)
+    if "z" in var.dims: 
+        var = var.rename({'z':'deptht'})
+        if (grid.depth is not None) and (var.sizes['deptht'] == grid.depth.size):
+            var = var.assign_coords(deptht=("deptht", grid.depth))
+    if "x" in var.dims: 
+        var = var.rename({'x':'lon', 'y':'lat'})
+        var = var.assign_coords(lat=("lat", grid.lat))
+        var = grid.sort(var)
+    return var
+
+########## mesh accessor ################
+
+def _get_mesh_stamp(varname):
+    '''
+    source file of a mesh field and the mtime stamp its sidecars are keyed on
+    '''
+    srcfile = BP12_BATHYFILE if varname in ["Bathymetry"] else BP12_MESHFILE
+    stamp = f"{os.stat(srcfile).st_mtime_ns}"
+    if srcfile != BP12_MESHFILE:
+        stamp = f"{stamp}-{os.stat(BP12_MESHFILE).st_mtime_ns}"
+    return srcfile, stamp
+
+def _write_mesh_sidecars(srcfile, varname, stamp):
+    '''
+    write native and sorted copies of a mesh field (time dim dropped)
+    as uncompressed .npy files in the mesh cache directory
+    '''
+    os.makedirs(BP12_MESHCACHE, exist_ok=True)
+    # only this field's sidecars, e3t must not match e3t_0_native_...
+    pattern = re.compile(rf"{re.escape(varname)}_(native|sorted)_[0-9-]+\.npy")
+    for oldfile in os.listdir(BP12_MESHCACHE):
+        if pattern.fullmatch(oldfile):
+            os.remove(f"{BP12_MESHCACHE}/{oldfile}")
+    with xr.open_dataset(srcfile, decode_times= False) as model_grid:
         var = model_grid[varname]
-        if varname in ['gdept_0']:
-            return model_grid.gdept_0[0,:]
         if "t" in var.dims:
             var = var.isel(t=0)
-        if is_sorted == 1:
-            if "x" in var.dims: var = var.rename({'x':'lon', 'y':'lat'})
-            if "z" in var.dims: 
-                var = var.rename({'z':'deptht'})
-                var = var.assign_coords(deptht=("deptht", model_grid.gdept_0[0,:].values),
-                                            lat=("lat", model_grid.nav_lat[:,0].values), 
-                                            lon=("lon", model_grid.nav_lon[0,:].values ))
-            else:
-                var = var.assign_coords(lat=("lat", model_grid.nav_lat[:,0].values), 
-                                        lon=("lon", model_grid.nav_lon[0,:].values ))
-            var = var.sortby('lon').drop_duplicates('lon', keep='first')    
-    return var
+        copies = {'native': var.values}
+        if "x" in var.dims:
+            copies['sorted'] = get_sortedgrid().sort(var, dim='x').values
+    for tag, values in copies.items():
+        tmpfile = f"{BP12_MESHCACHE}/{varname}_{tag}_{stamp}.{os.getpid()}.npy"
+        np.save(tmpfile, np.ascontiguousarray(values))
+        os.replace(tmpfile, f"{BP12_MESHCACHE}/{varname}_{tag}_{stamp}.npy")
+
+def get_bp12mesh(varname, is_sorted=1):
+    '''
+    returns a static mesh field (e1t, e2t, e3t, tmask, gdept_0, Bathymetry, ...)
+    as a read-only memory-mapped numpy array without the time dim.
+    Sidecar .npy copies (native and sorted) are written on first use and 
+    rebuilt when the grid file mtime changes; within a process the 
+    mapping is reused.
+    '''
+    srcfile, stamp = _get_mesh_stamp(varname)
+    key = (varname, is_sorted)
+    if (key in _BP12_MESH) and (_BP12_MESH[key][0] == stamp):
+        return _BP12_MESH[key][1]
+    
+    sidecar = f"{BP12_MESHCACHE}/{varname}_native_{stamp}.npy"
+    if not os.path.isfile(sidecar):
+        _write_mesh_sidecars(srcfile, varname, stamp)
+    tag = 'sorted' if is_sorted == 1 else 'native'
+    if not os.path.isfile(f"{BP12_MESHCACHE}/{varname}_{tag}_{stamp}.npy"):
+        tag = 'native'
+    values = np.load(f"{BP12_MESHCACHE}/{varname}_{tag}_{stamp}.npy", mmap_mode='r')
+    _BP12_MESH[key] = (stamp, values)
+    return values
+
+def get_bp12meshvar(varname, is_sorted=1):
+    '''
+    returns a static mesh field as a DataArray view on the 
+    memory-mapped array, on the sorted grid (lat, lon[, deptht] coords)
+    or with the native dims of the grid file
+    '''
+    values = get_bp12mesh(varname, is_sorted)
+    tkey = (varname, 'template')
+    if tkey not in _BP12_MESH or _BP12_MESH[tkey][0] != _BP12_MESH[(varname, is_sorted)][0]:
+        srcfile, stamp = _get_mesh_stamp(varname)
+        with xr.open_dataset(srcfile, decode_times= False) as model_grid:
+            var = model_grid[varname]
+            dims = tuple(dim for dim in var.dims if dim != "t")
+            coords = {name: (coord.dims, coord.values) for name, coord in var.coords.items() 
+                      if (coord.ndim == 1) and (coord.dims[0] in dims)}
+            _BP12_MESH[tkey] = (stamp, (dims, coords, dict(var.attrs)))
+    dims, coords, attrs = _BP12_MESH[tkey][1]
+    
+    if (is_sorted == 1) and ("x" in dims):
+        grid = get_sortedgrid()
+        rename = {'z': 'deptht', 'y': 'lat', 'x': 'lon'}
+        dims = tuple(rename.get(dim, dim) for dim in dims)
+        coords = {'lat': grid.lat, 'lon': grid.lon}
+        if ('deptht' in dims) and (values.shape[dims.index('deptht')] == grid.depth.size):
+            coords['deptht'] = grid.depth
+    return xr.DataArray(values, dims=dims, coords=coords, attrs=attrs, name=varname)
+
+########## grid files ################
+
+def get_bp12grid(varname, is_sorted=1):
+    ''' 
+    returns variable from files in the data/GRID directory
+    with grid sorted option, as a view on the cached mesh field
+    '''
+    if varname in ["Bathymetry", "gdept_0"]:
+        return get_bp12meshvar(varname, is_sorted=0)
+    return get_bp12meshvar(varname, is_sorted)
             
             
 def get_bp12input(varname, filename, is_sorted=1):
@@ -48,39 +268,99 @@ def get_bp12input(varname, filename, is_sorted=1):
     var = ds_in[varname]
     
     if is_sorted == 1:
-        if "z" in var.dims: var = var.rename({'z':'deptht'})
-        if "x" in var.dims:
-            ds_in = ds_in.rename({'x':'lon', 'y':'lat'})
-            ds_in = ds_in.assign_coords( lat=("lat", ds_in.nav_lat[:,0].values), 
-                                     lon=("lon", ds_in.nav_lon[0,:].values ))
-            var = ds_in[varname].sortby('lon').drop_duplicates('lon', keep='first')
+        var = sort_bp12var(var)
        
     return var
             
+########## depth integrals ################
 
-def make_obs_areagrid(lonin, latin):
+def get_bp12depthweights(zmin=0, zmax=None):
     '''
-    Calculates the area of each grid cell 
-    To define the corner values of latitude and longitude, 
-    we need to define the longtiude and latitude steps based on the product's resolution: 
-    The below code should therefore be working for any resolution product. 
-    Contributing author: A. D. Lebehot Last update: 8 Nov 2019
+    thickness (m) of each model level (deptht) inside zmin-zmax, 
+    from the level thicknesses e3t_0 (interfaces are their cumulative sum)
+    zmax=None is the full water column. Computed once per depth range.
+    '''
+    key = (zmin, zmax)
+    if key not in _BP12_DEPTHWEIGHTS:
+        e3t = np.asarray(get_bp12grid('e3t_0'), dtype=float)
+        depth = np.asarray(get_bp12grid('gdept_0'), dtype=float)
+        zbot = np.cumsum(e3t)
+        ztop = zbot - e3t
+        zmax_ = zbot[-1] if zmax is None else zmax
+        thick = np.clip(np.minimum(zbot, zmax_) - np.maximum(ztop, zmin), 0, None)
+        _BP12_DEPTHWEIGHTS[key] = xr.DataArray(thick, dims='deptht', 
+                                               coords={'deptht': depth}, name='e3t')
+    return _BP12_DEPTHWEIGHTS[key]
+
+def get_depth_tmask(var_in):
+    '''
+    land-sea mask (deptht, lat, lon) of the levels and columns of a 
+    variable on the sorted grid, levels matched on the nearest depth,
+    columns by position (or nearest lat/lon for a subset of the grid)
+    '''
+    tmask = get_bp12grid('tmask')
+    depth = np.asarray(get_bp12grid('gdept_0'), dtype=float)
+    levels = np.abs(depth[:, None] - var_in.deptht.values[None, :]).argmin(axis=0)
+    tmask = tmask.isel(deptht=levels)
+    if (tmask.sizes['lat'], tmask.sizes['lon']) != (var_in.sizes['lat'], var_in.sizes['lon']):
+        tmask = tmask.sel(lat=var_in.lat.values, lon=var_in.lon.values, method='nearest')
+    tmask = tmask.drop_vars([name for name in tmask.coords])
+    return tmask.assign_coords({dim: var_in[dim].values for dim in tmask.dims if dim in var_in.coords})
+
+def get_depth_integral(var_in, zmin=0, zmax=None, mean=False):
+    '''
+    integral over depth (units of var x m) of a variable with a 
+    deptht dim (e.g. get_bp12var(..., zlev=-1)) between zmin and zmax,
+    or the thickness weighted depth mean with mean=True.
+    Land and levels below the bottom (tmask 0, or NaN) do not contribute, 
+    columns with no ocean in the range are NaN.
+    The contraction is done per chunk (xr.dot), the weighted 
+    4D product is never formed.
     '''
-    R = 6371000 # Earth Radius (m) 
-    area_gridcell = np.ones([len(latin), len(lonin)])
-    step_latin = np.abs(latin[0].values - latin[1].values)/2
-    step_lonin = np.abs(lonin[0].values - lonin[1].values)/2
+    weights = get_bp12depthweights(zmin, zmax)
+    weights = weights.sel(deptht=var_in.deptht.values, method='nearest')
+    weights = weights.assign_coords(deptht=var_in.deptht.values)
+    weights = weights.isel(deptht=(weights > 0).values)
+    var_in = var_in.sel(deptht=weights.deptht)
+    
+    valid = var_in.notnull() & (get_depth_tmask(var_in) > 0)
+    var_int = xr.dot(var_in.where(valid, 0), weights, dims='deptht')
+    thick = xr.dot(valid.astype(float), weights, dims='deptht')
+    if mean:
+        var_int = var_int / thick
+    return var_int.where(thick > 0)
 
-    for i in range(len(latin)):
-        phi2 = (latin[i].values+step_latin)*pi/180
-        phi1 = (latin[i].values-step_latin)*pi/180
+########## obs grids ################
 
-        for j in range(len(lonin)):
-            lambda2 = (lonin[j].values+step_lonin)*pi/180
-            lambda1 = (lonin[j].values-step_lonin)*pi/180
+def get_cell_edges(axis):
+    '''
+    Returns the cell edges of a 1d axis of cell centres:
+    midway between centres, extended by half a step at both ends.
+    '''
+    axis = np.asarray(axis, dtype=float)
+    mids = 0.5 * (axis[1:] + axis[:-1])
+    return np.r_[2*axis[0] - mids[0], mids, 2*axis[-1] - mids[-1]]
 
-            area_gridcell[i,j] = R*R*(lambda2 - lambda1)*(np.sin(phi2) - np.sin(phi1))
-    return area_gridcell
+def make_obs_areagrid(lonin, latin):
+    '''
+    Calculates the area of each grid cell 
+    The corner values of latitude and longitude are taken from the 
+    cell edges so this works for any, also non-uniform, resolution. 
+    Results are memoized per (lon, lat) axis and returned read-only.
+    Contributing author: A. D. Lebehot Last update: 8 Nov 2019
+    '''
+    lonin, latin = np.asarray(lonin, dtype=float), np.asarray(latin, dtype=float)
+    key = (hash(lonin.tobytes()), hash(latin.tobytes()))
+    if key not in _OBS_AREAGRID:
+        R = 6371000 # Earth Radius (m) 
+        lambdas = np.deg2rad(get_cell_edges(lonin))
+        phis = np.deg2rad(get_cell_edges(latin))
+        dlambda = np.abs(np.diff(lambdas))
+        dsinphi = np.abs(np.diff(np.sin(phis)))
+        area_gridcell = R*R * dsinphi[:, None] * dlambda[None, :]
+        area_gridcell.flags.writeable = False
+        _OBS_AREAGRID[key] = area_gridcell
+    return _OBS_AREAGRID[key]
            
 def make_obs_areaweight(lonin, latin):
     '''
@@ -101,7 +381,191 @@ def get_biome_ts(var_in, biome_in, biome_val, vargridarea):
     from a xr dataset with 2d variable field (var_in) 
     with grid area weighting (vargridarea)
     '''
-    varbiome = var_in.where(biome_in.values==biome_val)
+    varbiome = var_in.where(biome_in.data==biome_val)
     var_weighted = varbiome.weighted(vargridarea)
     var_tsmean = var_weighted.mean(("lat", "lon"))
-    return var_tsmean
\ No newline at end of file
+    return var_tsmean
+
+
+########## biome statistics ################
+
+def _biome_partials(var_blk, label_blk, weight_blk, slot_blk, nbiome):
+    '''
+    weighted sums (w, w*x, w*x^2), count, min and max per biome label 
+    for one (time, lat, lon) block in a single pass using a flat 
+    (time, label) index. label_blk is (slot, lat, lon) and slot_blk
+    picks the mask slot of each time step. Labels < 0 are outside all biomes.
+    returns array (time, 1, 1, nbiome, 6)
+    '''
+    nt = var_blk.shape[0]
+    x = var_blk.reshape(nt, -1)
+    lab = label_blk.reshape(label_blk.shape[0], -1)[slot_blk]
+    w = np.broadcast_to(weight_blk.reshape(1, -1), x.shape)
+    valid = (lab >= 0) & ~np.isnan(x) & ~np.isnan(w)
+    
+    flat = (np.arange(nt)[:, None] * nbiome + lab)[valid]
+    xv, wv = x[valid], w[valid]
+    nflat = nt * nbiome
+    sums = np.zeros((nflat, 6))
+    sums[:, 0] = np.bincount(flat, weights=wv, minlength=nflat)
+    sums[:, 1] = np.bincount(flat, weights=wv*xv, minlength=nflat)
+    sums[:, 2] = np.bincount(flat, weights=wv*xv*xv, minlength=nflat)
+    sums[:, 3] = np.bincount(flat, minlength=nflat)
+    sums[:, 4], sums[:, 5] = np.inf, -np.inf
+    np.minimum.at(sums[:, 4], flat, xv)
+    np.maximum.at(sums[:, 5], flat, xv)
+    return sums.reshape(nt, 1, 1, nbiome, 6)
+
+def get_biome_labels(biome_in, biome_vals):
+    '''
+    convert a biome mask to a flat label index:
+    position of each biome value in biome_vals, -1 elsewhere
+    '''
+    biome_in = np.asarray(biome_in)
+    labels = np.full(biome_in.shape, -1, dtype=np.int16)
+    for ind, biome_val in enumerate(biome_vals):
+        labels[biome_in == biome_val] = ind
+    return labels
+
+def get_mask_slots(var_time, nslot, mask_time=None):
+    '''
+    index into the time-like dim of a biome mask (nslot long) 
+    for each time step of a variable:
+    1 -> static, 12 -> calendar month, 73 -> 5-day slot of 
+    the 365 day calendar (mu.BP12_CAL5D), else one mask per time step.
+    mask_time, the coordinate of the mask's time-like dim, is matched 
+    on its values when given: dates -> same time step (or the same 
+    month / 5-day slot for 12 / 73 masks), integers -> month / slot 
+    number (1-based). Raises ValueError when a time step has no mask.
+    '''
+    import bp12_tools.model_utils as mu
+    var_time = np.asarray(var_time)
+    ntime = np.size(var_time)
+    if nslot == 1:
+        return np.zeros(ntime, dtype=int)
+    if mask_time is not None:
+        mask_time = np.asarray(mask_time)
+        if np.issubdtype(mask_time.dtype, np.datetime64):
+            slots = _match_mask_values(mask_time, var_time.astype(mask_time.dtype))
+            if (slots is None) and (nslot in [12, 73]):
+                to_slot = mu.BP12_CAL5D.get_months if nslot == 12 else mu.BP12_CAL5D.get_slots
+                slots = _match_mask_values(to_slot(mask_time), to_slot(var_time))
+        elif np.issubdtype(mask_time.dtype, np.integer) and (nslot in [12, 73]):
+            var_slots = mu.BP12_CAL5D.get_months(var_time) if nslot == 12 \
+                        else mu.BP12_CAL5D.get_slots(var_time) + 1
+            slots = _match_mask_values(mask_time, var_slots)
+        else:
+            slots = None if nslot != ntime else np.arange(ntime)
+        if slots is None:
+            raise ValueError(f"biome mask time coordinate ({nslot} entries) does not "
+                             f"cover the {ntime} time steps of the variable")
+        return slots
+    if nslot == 12:
+        return mu.BP12_CAL5D.get_months(var_time) - 1
+    if nslot == 73:
+        return mu.BP12_CAL5D.get_slots(var_time)
+    if nslot != ntime:
+        raise ValueError(f"biome mask has {nslot} time entries, expected 1, 12, 73 "
+                         f"or one per time step of the variable ({ntime})")
+    return np.arange(ntime)
+
+def _match_mask_values(mask_vals, var_vals):
+    '''
+    position of each of var_vals in mask_vals (unique), None if one is missing
+    '''
+    mask_vals, var_vals = np.asarray(mask_vals), np.asarray(var_vals)
+    if np.unique(mask_vals).size != mask_vals.size:
+        return None
+    order = np.argsort(mask_vals)
+    pos = np.clip(np.searchsorted(mask_vals[order], var_vals), 0, mask_vals.size - 1)
+    if not np.all(mask_vals[order][pos] == var_vals):
+        return None
+    return order[pos]
+
+def get_biome_blocks(var_in, biome_in, biome_vals=None):
+    '''
+    dask inputs for blockwise biome reductions of a (time, lat, lon) 
+    variable: variable data, biome labels (slot, lat, lon) chunked like 
+    the variable, the mask slot of each time step and the biome values.
+    biome_in is either static (lat, lon) or has one leading time-like dim.
+    '''
+    import dask.array as da
+    vardata = var_in.data
+    if not isinstance(vardata, da.Array):
+        vardata = da.from_array(vardata, chunks=vardata.shape)
+
+    # biome mask as (slot, lat, lon) chunked like the variable
+    maskdims = [dim for dim in biome_in.dims if dim not in ['lat', 'lon']]
+    biome_in = biome_in.transpose(*maskdims, 'lat', 'lon')
+    maskdata = biome_in.data
+    if not isinstance(maskdata, da.Array):
+        maskdata = da.from_array(maskdata, chunks=maskdata.shape)
+    if not maskdims:
+        maskdata = maskdata[None, :, :]
+    maskdata = maskdata.rechunk((-1,) + vardata.chunks[1:])
+    mask_time = None
+    if maskdims and (maskdims[0] in biome_in.coords):
+        mask_time = biome_in[maskdims[0]].values
+    slots = get_mask_slots(var_in.time, maskdata.shape[0], mask_time)
+    slots = da.from_array(slots, chunks=(vardata.chunks[0],))
+    
+    if biome_vals is None:
+        biome_vals = da.unique(maskdata).compute()
+        biome_vals = biome_vals[~np.isnan(biome_vals)]
+    biome_vals = np.asarray(biome_vals)
+    labels = maskdata.map_blocks(get_biome_labels, biome_vals, dtype=np.int16)
+    return vardata, labels, slots, biome_vals
+
+def get_biome_stats(var_in, biome_in, vargridarea, biome_vals=None):
+    '''
+    Area weighted mean, std, min, max and gridpoint count of a 
+    (time, lat, lon) variable (var_in) for every biome in the 
+    biome mask (biome_in) at once, with grid area weighting (vargridarea).
+    biome_in is either static (lat, lon) or has one leading time-like 
+    dim (month/5-day climatology or one mask per time step), which is 
+    matched lazily to the time axis of var_in.
+    Each chunk of var_in is read once for all biomes and the 
+    reduction stays lazy for dask input.
+    returns Dataset indexed by (time, biome)
+    '''
+    import dask.array as da
+    has_time = 'time' in var_in.dims
+    if not has_time:
+        var_in = var_in.expand_dims('time')
+    var_in = var_in.transpose('time', 'lat', 'lon')
+    vardata, labels, slots, biome_vals = get_biome_blocks(var_in, biome_in, biome_vals)
+    nbiome = biome_vals.size
+    weights = da.from_array(np.asarray(vargridarea, dtype=float), 
+                            chunks=vardata.chunks[1:])
+    
+    partials = da.blockwise(_biome_partials, 'tyxbs', 
+                            vardata, 'tyx', labels, 'myx', weights, 'yx', slots, 't',
+                            nbiome=nbiome, new_axes={'b': nbiome, 's': 6},
+                            adjust_chunks={'y': lambda c: 1, 'x': lambda c: 1},
+                            concatenate=True, dtype=float)
+    
+    # combine partials across spatial chunks
+    sums = partials[..., :4].sum(axis=(1, 2))
+    sw, swx, swx2, count = sums[..., 0], sums[..., 1], sums[..., 2], sums[..., 3]
+    vmin = partials[..., 4].min(axis=(1, 2))
+    vmax = partials[..., 5].max(axis=(1, 2))
+    empty = (count == 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = swx / sw
+        std = da.sqrt(da.maximum(swx2 / sw - mean**2, 0))
+    
+    dims = ('time', 'biome')
+    ds_out = xr.Dataset(
+        data_vars={
+            'mean': (dims, mean),
+            'std': (dims, std),
+            'min': (dims, da.where(empty, np.nan, vmin)),
+            'max': (dims, da.where(empty, np.nan, vmax)),
+            'count': (dims, count.astype(np.int64)),
+        },
+        coords={'time': var_in.time, 'biome': biome_vals})
+    if not has_time:
+        ds_out = ds_out.isel(time=0, drop=True)
+    if not isinstance(var_in.data, da.Array):
+        ds_out = ds_out.compute()
+    return ds_out
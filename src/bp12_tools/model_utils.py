@@ -4,6 +4,7 @@ import xarray as xr
 import re
 import os
 from pathlib import Path
+import bp12_tools.grid_utils as gu
 
 ################################################################################### 
 #
@@ -11,43 +12,108 @@ from pathlib import Path
 #
 ################################################################################### 
 
+########## 5-day calendar ################
+
+class BP12Calendar5d:
+    '''
+    The 365 day calendar of the 5-day mean model output: 73 slots 
+    a year, each dated by its last day (day of year 5, 10, ..., 365) 
+    at 12:00 as in the file names. Lookup tables map slot -> doy, 
+    month, day, season and doy -> month, day, all conversions work 
+    on whole numpy datetime64 arrays. Feb 29 falls on doy 60 (Mar 1).
+    '''
+    nslot = 73
+    ndays = 365
+
+    def __init__(self):
+        mdays = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+        self.cumdays = np.r_[0, np.cumsum(mdays)[:-1]]
+        self.doy_month = np.repeat(np.arange(1, 13), mdays)
+        self.doy_day = np.arange(1, self.ndays+1) - self.cumdays[self.doy_month - 1]
+        self.slot_doy = self.ndays // self.nslot * np.arange(1, self.nslot+1)
+        self.slot_month = self.doy_month[self.slot_doy - 1]
+        self.slot_day = self.doy_day[self.slot_doy - 1]
+        # 0-3: DJF, MAM, JJA, SON
+        self.slot_season = (self.slot_month % 12) // 3
+
+    def to_datetime(self, yr, mm, dd, hour=12):
+        '''
+        datetime64[ns] array from year, month, day arrays
+        '''
+        yr, mm, dd = np.broadcast_arrays(np.asarray(yr), np.asarray(mm), np.asarray(dd))
+        months = ((yr - 1970) * 12 + mm - 1).astype('datetime64[M]')
+        days = months.astype('datetime64[D]') + (dd - 1).astype('timedelta64[D]')
+        return (days + np.timedelta64(hour, 'h')).astype('datetime64[ns]')
+
+    def get_dates(self, y1, y2=None):
+        '''
+        the dates of every 5-day mean of the years y1-y2 (or y1)
+        '''
+        years = np.arange(int(y1), int(y1 if y2 is None else y2)+1)
+        return self.get_slot_dates(np.repeat(years, self.nslot), 
+                                   np.tile(np.arange(self.nslot), years.size))
+
+    def get_slot_dates(self, yr, slot):
+        return self.to_datetime(yr, self.slot_month[slot], self.slot_day[slot])
+
+    def get_ymd(self, dates):
+        '''
+        year, month, day arrays of datetime64-like dates
+        '''
+        dates = np.atleast_1d(np.asarray(dates, dtype='datetime64[ns]'))
+        months = dates.astype('datetime64[M]')
+        yr = months.astype(int) // 12 + 1970
+        mm = months.astype(int) % 12 + 1
+        dd = (dates.astype('datetime64[D]') - months.astype('datetime64[D]')).astype(int) + 1
+        return yr, mm, dd
+
+    def get_doy(self, dates):
+        _, mm, dd = self.get_ymd(dates)
+        return np.minimum(self.cumdays[mm - 1] + dd, self.ndays)
+
+    def get_slots(self, dates):
+        '''
+        5-day slot 0-72 of each date
+        '''
+        return (self.get_doy(dates) - 1) // (self.ndays // self.nslot)
+
+    def get_months(self, dates):
+        return self.get_ymd(dates)[1]
+
+    def get_seasons(self, dates):
+        return (self.get_months(dates) % 12) // 3
+
+    def get_tags(self, dates):
+        '''
+        file name date tags (y2004m01d05) of dates
+        '''
+        yr, mm, dd = self.get_ymd(dates)
+        return np.array([f"y{y}m{m:02}d{d:02}" for y, m, d in zip(yr, mm, dd)])
+
+    def parse_tags(self, tags):
+        '''
+        dates of file name date tags (y2004m01d05)
+        '''
+        ymd = np.char.translate(np.atleast_1d(np.asarray(tags, dtype=str)), 
+                                {ord(c): None for c in 'ymd'}).astype(int)
+        return self.to_datetime(ymd // 10000, ymd // 100 % 100, ymd % 100)
+
+BP12_CAL5D = BP12Calendar5d()
+
 def get_mmdd_5d(yr):
     '''
     Gets a string for the dates of model 5d averages from a 
     365 day calendar for the specified year.
     '''
-    ts = []
-    for mo in range(1,13):
-            if mo in [1,4,5]:
-                D= [5,10,15,20,25,30]
-            elif mo ==2:
-                D=[4,9,14,19,24]
-            elif mo in [3,12]:
-                D=[1,6,11,16,21,26,31]
-            elif mo in [6,7]:
-                D=[4,9,14,19,24,29]
-            elif mo == 8:
-                D=[3,8,13,18,23,28]
-            elif mo in [9,10]:
-                D=[2,7,12,17,22,27]
-            elif mo in [11]:
-                D=[1,6,11,16,21,26]
-            for dd in D:
-                ts.append(f"y{yr}m{mo:02}d{dd:02}")
-    return ts
+    return BP12_CAL5D.get_tags(BP12_CAL5D.get_dates(yr)).tolist()
 
 def make_timeaxis_5d(y1,y2):   
     '''
-    Gets a list of pandas timestamps corresponding to 
+    Gets the pandas timestamps corresponding to 
     the dates of model 5d averages on a 365 day calendar 
     for the specified year range.
     '''
-    yr1, yr2 = int(y1), int(y2)
-    ts = []
-    for yr in range(yr1, yr2+1):
-        for dstr in get_mmdd_5d(yr): 
-            ts.append(pd.Timestamp(int(dstr[1:5]), int(dstr[6:8]), int(dstr[9:11]) ,12))
-    return ts
+    return pd.DatetimeIndex(BP12_CAL5D.get_dates(y1, y2))
   
 def get_filetype(varin):
     '''
@@ -98,19 +164,10 @@ def get_weightmodel(is_sorted=1):
     if is_sorted is one a sorted dataarray with coordinates is returned
     else uses the default output 
     '''
-    meshfile = f"../data/GRID/BIOPERIANT12_grid.nc"
-    model_grid = xr.open_dataset(meshfile, decode_times= False) 
-    
-    tmask = model_grid.tmask[0,0,:] 
-    e1t = model_grid.e1t[0,0,:] 
-    e2t = model_grid.e2t[0,0,:]
-    area_model = tmask * e1t * e2t
-    
-    if is_sorted == 1:
-        area_model = area_model.rename({'y':'lat', 'x':'lon'})
-        area_model = area_model.assign_coords(lat=("lat", model_grid.nav_lat[:,0].values), 
-                                              lon=("lon", model_grid.nav_lon[0,:].values))
-        area_model = area_model.sortby('lon').drop_duplicates('lon', keep='first') 
+    tmask = gu.get_bp12meshvar('tmask', is_sorted)[0,:] 
+    e1t = gu.get_bp12meshvar('e1t', is_sorted)
+    e2t = gu.get_bp12meshvar('e2t', is_sorted)
+    area_model = tmask.drop_vars('deptht', errors='ignore') * e1t * e2t
     
     total_area_model = np.sum(area_model)
     weight_model = area_model/total_area_model
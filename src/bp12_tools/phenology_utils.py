@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import bp12_tools.chpc_utils as cu
+import bp12_tools.grid_utils as gu
+import bp12_tools.model_utils as mu
+
+###################################################
+#
+# Contains functions for phytoplankton bloom
+# phenology (initiation, peak, termination, duration)
+# on July-June bloom years, vectorized over gridpoints
+#
+###################################################
+
+PHEN_FACTOR = 1.05
+# first month of a bloom year, as in formatting.get_mo_titles
+PHEN_START_MONTH = 7
+
+def get_bloom_years(var_time):
+    '''
+    bloom year (July-June) of each timestamp, labelled by the year it starts
+    '''
+    var_time = pd.DatetimeIndex(np.atleast_1d(var_time))
+    return np.asarray(var_time.year - (var_time.month < PHEN_START_MONTH))
+
+def _phen_core(x, bloomyrs, years, times, factor):
+    '''
+    bloom initiation, peak and termination times along the last axis of x
+    for each bloom year in years: first / last time step at or above
+    factor x the bloom year median, and the time of the maximum.
+    Gridpoints never above threshold give NaT.
+    '''
+    shape = x.shape[:-1]
+    x = np.asarray(x, dtype=float).reshape(-1, x.shape[-1])
+    npts, nyr = x.shape[0], len(years)
+    out = [np.full((npts, nyr), np.datetime64('NaT'), dtype='datetime64[ns]')
+           for i in range(3)]
+    for iy, yr in enumerate(years):
+        it = np.where(bloomyrs == yr)[0]
+        xb, tb = x[:, it], times[it]
+        isnan = np.isnan(xb)
+        valid = ~isnan.all(axis=1)
+        if not valid.any():
+            continue
+        with np.errstate(invalid='ignore'):
+            thresh = np.nanmedian(xb[valid], axis=1) * factor
+            above = np.zeros(xb.shape, dtype=bool)
+            above[valid] = xb[valid] >= thresh[:, None]
+        bloom = above.any(axis=1)
+        i0 = np.argmax(above, axis=1)
+        i1 = it.size - 1 - np.argmax(above[:, ::-1], axis=1)
+        ipk = np.argmax(np.where(isnan, -np.inf, xb), axis=1)
+        for iout, ind in enumerate([i0, ipk, i1]):
+            out[iout][bloom, iy] = tb[ind[bloom]]
+    return tuple(o.reshape(shape + (nyr,)) for o in out)
+
+def get_phenology(chl_in, factor=PHEN_FACTOR):
+    '''
+    Bloom phenology at every gridpoint of a (time, lat, lon) chl field
+    for each complete July-June bloom year in its time axis:
+    initiation_ts / termination_ts: first / last time chl >= factor x median
+                                    of the bloom year
+    max_time:                       time of the bloom year maximum
+    duration_ts:                    termination - initiation
+    Bloom years run in one loop inside each chunk, spatial chunks
+    are processed in parallel under dask.
+    returns Dataset with dims (bloomyear, lat, lon)
+    '''
+    if not 'time' in chl_in.dims:
+        chl_in = chl_in.rename({'time_counter':'time'})
+    if chl_in.chunks is not None:
+        chl_in = chl_in.chunk({'time': -1})
+    bloomyrs = get_bloom_years(chl_in.time.values)
+    # only bloom years with the full number of time steps
+    years, nstep = np.unique(bloomyrs, return_counts=True)
+    years = years[nstep == nstep.max()]
+
+    phen = xr.apply_ufunc(_phen_core, chl_in,
+                          kwargs={'bloomyrs': bloomyrs, 'years': years,
+                                  'times': chl_in.time.values.astype('datetime64[ns]'),
+                                  'factor': factor},
+                          input_core_dims=[['time']],
+                          output_core_dims=[['bloomyear']]*3,
+                          dask='parallelized', output_dtypes=['datetime64[ns]']*3,
+                          dask_gufunc_kwargs={'output_sizes': {'bloomyear': years.size}})
+    ds_out = xr.Dataset({'initiation_ts': phen[0], 'max_time': phen[1],
+                         'termination_ts': phen[2],
+                         'duration_ts': phen[2] - phen[0]})
+    ds_out = ds_out.assign_coords(bloomyear=years).transpose('bloomyear', ...)
+    ds_out.attrs['threshold'] = f"{factor} x bloom year median"
+    return ds_out
+
+def get_clim_bloomyear(chl_in, yr=2000):
+    '''
+    climatological 5-day cycle of chl_in on the July-June
+    bloom year starting in yr (model 5-day time axis),
+    slots without data in chl_in are NaN
+    '''
+    slots = gu.get_mask_slots(chl_in.time, 73)
+    clim = chl_in.groupby(xr.DataArray(slots, dims='time', name='slot')).mean('time')
+    ts = mu.make_timeaxis_5d(yr, yr+1)
+    ts = ts[get_bloom_years(ts) == yr]
+    clim = clim.reindex(slot=mu.BP12_CAL5D.get_slots(ts))
+    return clim.rename({'slot': 'time'}).assign_coords(time=ts)
+
+def make_bp12phenology(y1, y2, outprefix, zlev=0, factor=PHEN_FACTOR):
+    '''
+    Bloom phenology of model chl (NCHL + DCHL) at depth level zlev
+    for the years y1-y2 written to
+    {outprefix}_PHENOLOGY.nc      : each complete bloom year
+    {outprefix}_PHENOLOGY_clim.nc : the climatological bloom year
+    Spatial tiles are sized so one tile holds all years.
+    '''
+    years = range(int(y1), int(y2)+1)
+    chunkmem = cu.BP12_CHUNKMEM // len(years)
+    chlyrs = [cu.get_bp12var('chl', f"y{yr}", zlev, chunkmem=chunkmem) for yr in years]
+    chlyrs = [chl for chl in chlyrs if chl is not None]
+    if not chlyrs:
+        return None
+    chl = xr.concat(chlyrs, dim='time')
+
+    phenfile = f"{outprefix}_PHENOLOGY.nc"
+    get_phenology(chl, factor).to_netcdf(phenfile)
+    climfile = f"{outprefix}_PHENOLOGY_clim.nc"
+    ds_clim = get_phenology(get_clim_bloomyear(chl), factor).isel(bloomyear=0, drop=True)
+    ds_clim.attrs['years'] = f"{y1}-{y2}"
+    ds_clim.to_netcdf(climfile)
+    return phenfile, climfile
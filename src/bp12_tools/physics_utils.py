@@ -0,0 +1,269 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import bp12_tools.chpc_utils as cu
+import bp12_tools.clim_utils as cl
+import bp12_tools.grid_utils as gu
+import bp12_tools.model_utils as mu
+
+###################################################
+#
+# Contains functions for physical diagnostics
+# of the model output (fronts, heat content, eddy
+# kinetic energy, sea ice, ...)
+#
+###################################################
+
+########## fronts ################
+
+# front = northernmost latitude where the variable at the given depth
+# (m, None for surface fields) is below the threshold value
+FRONT_CRITERIA = {
+    'PF':  {'varname': 'votemper', 'depth': 200, 'value': 2.0},
+    'SAF': {'varname': 'votemper', 'depth': 400, 'value': 4.0},
+}
+FRONT_LATRANGE = (-70, -30)
+
+def _front_lat_core(x, lat, value):
+    '''
+    northernmost crossing of value along the last axis of x (lat ascending)
+    '''
+    nlat = lat.size
+    below = x < value
+    inorth = nlat - 1 - np.argmax(below[..., ::-1], axis=-1)
+    i1 = np.minimum(inorth + 1, nlat - 1)
+    v0 = np.take_along_axis(x, inorth[..., None], axis=-1)[..., 0]
+    v1 = np.take_along_axis(x, i1[..., None], axis=-1)[..., 0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.clip((value - v0) / (v1 - v0), 0, 1)
+    frontlat = lat[inorth] + np.nan_to_num(frac) * (lat[i1] - lat[inorth])
+    return np.where(below.any(axis=-1), frontlat, np.nan)
+
+def get_front_lat(var_in, value, latrange=FRONT_LATRANGE):
+    '''
+    latitude per (time, lon) of the northernmost crossing of value:
+    first point below value scanning each column from the north,
+    interpolated linearly to the crossing with the point north of it.
+    Columns without a crossing (or all land) are NaN.
+    '''
+    var_in = var_in.sel(lat=slice(*latrange))
+    if var_in.chunks is not None:
+        var_in = var_in.chunk({'lat': -1})
+    return xr.apply_ufunc(_front_lat_core, var_in, 
+                          kwargs={'lat': var_in.lat.values, 'value': value},
+                          input_core_dims=[['lat']], 
+                          dask='parallelized', output_dtypes=[float])
+
+def get_bp12fronts_year(yr, fronts=('SAF', 'PF'), latrange=FRONT_LATRANGE):
+    '''
+    front latitude per (time, lon) for every 5-day step of one year,
+    each variable/depth level is read once for all fronts using it
+    returns dict front -> DataArray
+    '''
+    fronts_out, varcache = {}, {}
+    for front in fronts:
+        crit = FRONT_CRITERIA[front]
+        zlev = 0
+        if crit['depth'] is not None:
+            depths = cu.get_bp12var(crit['varname'], f"y{yr}", -1, layout='map').deptht
+            zlev = int(mu.find_ind(crit['depth'], depths.values))
+        key = (crit['varname'], zlev)
+        if key not in varcache:
+            varcache[key] = cu.get_bp12var(crit['varname'], f"y{yr}", zlev, layout='map')
+        fronts_out[front] = get_front_lat(varcache[key], crit['value'], latrange).compute()
+    return fronts_out
+
+def make_bp12fronts(y1, y2, outprefix, fronts=('SAF', 'PF'), nworkers=1):
+    '''
+    Front latitudes from the 5-day model output for the years y1-y2,
+    averaged per month and written as {outprefix}_{front}_IA_monthly.nc
+    with variable lat (time, lon), the layout of the existing front files.
+    Years run in parallel on nworkers processes.
+    '''
+    years = list(range(int(y1), int(y2)+1))
+    if nworkers > 1:
+        with cu.get_bp12pool(nworkers) as pool:
+            results = list(pool.map(get_bp12fronts_year, years, [fronts]*len(years)))
+    else:
+        results = [get_bp12fronts_year(yr, fronts) for yr in years]
+
+    filenames = []
+    for front in fronts:
+        frontlat = xr.concat([res[front] for res in results], dim='time')
+        frontlat = frontlat.resample(time='MS').mean()
+        frontlat['time'] = frontlat.time + pd.Timedelta(days=14)
+        filename = f"{outprefix}_{front}_IA_monthly.nc"
+        frontlat.to_dataset(name='lat').to_netcdf(filename)
+        filenames.append(filename)
+    return filenames
+
+########## heat content ################
+
+BP12_RHO0 = 1026.
+BP12_CP = 3991.86795711963
+
+def get_ohc(temp_in, zmin=0, zmax=None):
+    '''
+    ocean heat content (J m-2) between zmin and zmax (m) from 
+    temperature (degC) with a deptht dim, see gu.get_depth_integral
+    '''
+    ohc = BP12_RHO0 * BP12_CP * gu.get_depth_integral(temp_in, zmin, zmax)
+    ohc.name = 'OHC'
+    ohc.attrs['units'] = 'J m-2'
+    return ohc
+
+########## eddy kinetic energy ################
+
+EKE_LATRANGE = (-70, -30)
+
+def get_uv_tpoints(var_in, varname):
+    '''
+    interpolate a C-grid velocity on the sorted grid to T points:
+    u (vozocrtx) from the U points either side in lon (periodic),
+    v (vomecrty) from the V points either side in lat
+    '''
+    if varname == 'vozocrtx':
+        return 0.5 * (var_in + var_in.roll(lon=1, roll_coords=False))
+    return 0.5 * (var_in + var_in.shift(lat=1))
+
+def get_bp12uv_acc_year(yr, zlev=0):
+    '''
+    running mean and variance (cl.make_accumulator) of u and v at 
+    T points over the 5-day files of one year, one slice in memory
+    '''
+    accs, coords = {}, None
+    for varname in ['vozocrtx', 'vomecrty']:
+        for var in cu.iter_bp12var(varname, f"y{yr}", zlev):
+            var = get_uv_tpoints(var, varname)
+            if varname not in accs:
+                accs[varname] = cl.make_accumulator(1, var.shape)
+                coords = {dim: var[dim].values for dim in var.dims}
+            cl.update_accumulator(accs[varname], 0, var.values.astype(float))
+    return accs, coords
+
+def make_bp12eke(y1, y2, outprefix, zlev=0, nworkers=1, latrange=EKE_LATRANGE):
+    '''
+    Eddy kinetic energy 0.5 (var(u) + var(v)) (m2 s-2) at T points 
+    over the years y1-y2 from the 5-day gridU/gridV files, one pass 
+    with streaming mean removal. Years run on nworkers processes and 
+    are merged at the end. Writes
+    {outprefix}_EKE_surf_mean.nc     : eke (lat, lon)
+    {outprefix}_EKE_SOzonal_mean.nc  : eke (lat) zonal mean in latrange
+    {outprefix}_EKE_SOmerid_mean.nc  : eke (lon) meridional mean in latrange
+    ("surf" is replaced by z{zlev} below the surface)
+    '''
+    years = list(range(int(y1), int(y2)+1))
+    if nworkers > 1:
+        with cu.get_bp12pool(nworkers) as pool:
+            results = list(pool.map(get_bp12uv_acc_year, years, [zlev]*len(years)))
+    else:
+        results = [get_bp12uv_acc_year(yr, zlev) for yr in years]
+    results = [res for res in results if res[0]]
+    if not results:
+        return None
+
+    accs, coords = results[0]
+    for accs_yr, _ in results[1:]:
+        for varname in accs:
+            cl.merge_accumulator(accs[varname], accs_yr[varname])
+    var_uv = [cl.get_accumulator_stats(accs[varname], ddof=0)[1][0]**2 for varname in accs]
+    tmask = gu.get_bp12grid('tmask').isel(deptht=zlev)
+    # u and v are interpolated to T points, label them with the T grid
+    coords = dict(coords, lat=tmask.lat.values, lon=tmask.lon.values)
+    eke = xr.DataArray(0.5 * sum(var_uv), dims=tuple(coords), coords=coords, name='eke')
+    eke = eke.where(tmask.values == 1)
+    eke.attrs.update(units='m2 s-2', years=f"{y1}-{y2}")
+
+    tag = 'surf' if zlev == 0 else f"z{zlev}"
+    eke_so = eke.sel(lat=slice(*latrange))
+    filenames = [f"{outprefix}_EKE_{tag}_mean.nc", 
+                 f"{outprefix}_EKE_SOzonal_mean.nc", f"{outprefix}_EKE_SOmerid_mean.nc"]
+    eke.to_dataset().to_netcdf(filenames[0])
+    eke_so.mean('lon').to_dataset().to_netcdf(filenames[1])
+    eke_so.mean('lat').to_dataset().to_netcdf(filenames[2])
+    return filenames
+
+########## sea ice ################
+
+SIE_THRESHOLD = 0.15
+
+def get_bp12cellarea():
+    '''
+    ocean cell area tmask*e1t*e2t (m2) of the surface level on the 
+    sorted grid (lat, lon), from the cached mesh fields
+    '''
+    tmask = gu.get_bp12grid('tmask').isel(deptht=0, drop=True)
+    return tmask * gu.get_bp12grid('e1t') * gu.get_bp12grid('e2t')
+
+def get_sea_ice_extent_area(ice_in, area, threshold=SIE_THRESHOLD):
+    '''
+    sea-ice extent (area of cells with ice fraction >= threshold) and 
+    sea-ice area (sum of area x ice fraction) in 10^6 km2 of an ice 
+    fraction field (..., lat, lon), both from one matrix product 
+    with the cell areas per time step
+    '''
+    ice = np.nan_to_num(np.asarray(ice_in, dtype=float))
+    ice = ice.reshape(ice.shape[:-2] + (-1,))
+    weights = np.stack([ice >= threshold, ice], axis=-1)
+    sie_sia = np.einsum('...nk,n->...k', weights, np.asarray(area, dtype=float).ravel()) * 1e-12
+    return sie_sia[..., 0], sie_sia[..., 1]
+
+def get_bp12seaice_year(yr, threshold=SIE_THRESHOLD):
+    '''
+    sea-ice extent and area of every 5-day step of one year, and the 
+    monthly accumulator (cl.make_accumulator) of the ice fraction map,
+    one time slice in memory
+    returns times, sie, sia, acc, coords
+    '''
+    area = get_bp12cellarea().values
+    times, sie, sia, acc, coords = [], [], [], None, None
+    for ice in cu.iter_bp12var('ileadfra', f"y{yr}", 0):
+        ice = ice.squeeze(drop=True)
+        if acc is None:
+            acc = cl.make_accumulator(12, ice.shape)
+            coords = {dim: ice[dim].values for dim in ice.dims}
+        values = ice.values.astype(float)
+        sie_t, sia_t = get_sea_ice_extent_area(values, area, threshold)
+        times.append(ice.time.values)
+        sie.append(sie_t)
+        sia.append(sia_t)
+        cl.update_accumulator(acc, cl.get_clim_slots(ice.time.values, 'month')[0], values)
+    return times, sie, sia, acc, coords
+
+def make_bp12seaice(y1, y2, outprefix, nworkers=1, threshold=SIE_THRESHOLD):
+    '''
+    Sea-ice extent and area from ileadfra in the 5-day icemod files 
+    for the years y1-y2. Years run on nworkers processes. Writes
+    {outprefix}_timeseries_sie_IA_monthly.nc : sie, sia (time) monthly means in 10^6 km2
+    {outprefix}_seaice_clim_monthly.nc       : ileadfra (time, lat, lon) monthly 
+                                               climatology, time = month 1-12
+    '''
+    years = list(range(int(y1), int(y2)+1))
+    if nworkers > 1:
+        with cu.get_bp12pool(nworkers) as pool:
+            results = list(pool.map(get_bp12seaice_year, years, [threshold]*len(years)))
+    else:
+        results = [get_bp12seaice_year(yr, threshold) for yr in years]
+    results = [res for res in results if res[3] is not None]
+    if not results:
+        return None
+
+    time = np.concatenate([res[0] for res in results])
+    ds_ts = xr.Dataset({'sie': ('time', np.concatenate([res[1] for res in results])),
+                        'sia': ('time', np.concatenate([res[2] for res in results]))},
+                       coords={'time': time})
+    ds_ts = ds_ts.resample(time='MS').mean()
+    ds_ts['time'] = ds_ts.time + pd.Timedelta(days=14)
+    ds_ts['sie'].attrs.update(units='10^6 km2', threshold=threshold)
+    ds_ts['sia'].attrs['units'] = '10^6 km2'
+    tsfile = f"{outprefix}_timeseries_sie_IA_monthly.nc"
+    ds_ts.to_netcdf(tsfile)
+
+    acc, coords = results[0][3], results[0][4]
+    for res in results[1:]:
+        cl.merge_accumulator(acc, res[3])
+    climfile = f"{outprefix}_seaice_clim_monthly.nc"
+    ds_clim = cl._make_clim_ds(acc, tuple(coords), coords, np.arange(1, 13), 'ileadfra')
+    ds_clim.attrs['years'] = f"{y1}-{y2}"
+    ds_clim.to_netcdf(climfile)
+    return tsfile, climfile
@@ -1,18 +1,36 @@
 __version__ = "0.0"
 __author__ = "Nicolette Chang"
 
-__all__ = ["maps", "timeseries", "formatting"]
+__all__ = ["maps", "timeseries", "formatting", "figures", "runner"]
 
-# Set global matplotlib params
-import matplotlib as mpl
-mpl.rcParams['savefig.dpi'] = 300
-mpl.rcParams['figure.figsize'] = [10, 5]
-mpl.rcParams['font.size'] = 12
-mpl.rcParams['font.family'] = 'Arial'
-mpl.rcParams['axes.titlesize'] =12
-mpl.rcParams['axes.labelsize'] =10
+# Global matplotlib params, applied with set_style()
+BP12_RCPARAMS = {
+    'savefig.dpi': 300,
+    'figure.figsize': [10, 5],
+    'font.size': 12,
+    'font.family': 'Arial',
+    'axes.titlesize': 12,
+    'axes.labelsize': 10,
+}
 
-# Import the submodules
-from . import maps
-from . import timeseries
-from . import formatting
+def set_style(rc=None):
+    '''
+    apply the manuscript matplotlib params (BP12_RCPARAMS),
+    rc overrides single params by their rcParams key 
+    e.g. set_style({'font.size': 10, 'savefig.pad_inches': 0.05})
+    '''
+    import matplotlib as mpl
+    params = dict(BP12_RCPARAMS)
+    params.update(rc or {})
+    mpl.rcParams.update(params)
+
+# Submodules are imported on first access
+import importlib
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,80 @@
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib import colors
+from cartopy import crs as ccrs
+
+from bp12_tools.plot_utils import maps
+from bp12_tools.plot_utils.formatting import get_label_mplstr, get_biome_colors
+
+###################################################
+#
+# Contains the manuscript figures as plot functions
+# for the figure runner (figures/figure_specs.json),
+# each function(inputs, **kwargs) -> Figure with
+# inputs the opened datasets of its spec
+#
+###################################################
+
+BIOME_BOUNDS = np.array([7, 13, 14, 15, 16, 17, 18])
+BIOME_TICKS = [9.5, 13.5, 14.5, 15.5, 16.5, 17.5]
+BIOME_LABELS = ['SP-STPS', 'SA-STPS', 'IND-STPS', 'SO-STSS', 'SO-SPSS', 'SO-ICE']
+
+def add_stereo_axes(fig, *args):
+    return fig.add_subplot(*args, projection=ccrs.Stereographic(central_latitude=-90))
+
+########## f02 ################
+
+def plot_f02(inputs):
+    '''
+    surface EKE of (a) the model and (b) AVISO
+    inputs: model, obs (eke on lat, lon)
+    '''
+    import cmocean as cmo
+    from cmcrameri import cm
+    cmap_eke = cmo.tools.crop_by_percent(cm.vikO, 15, which='both', N=None)
+    bounds = np.concatenate((np.arange(0,100,10), np.arange(100,1100,100)))
+    norm_eke = colors.BoundaryNorm(bounds, cmap_eke.N, extend='max')
+    eke_label = f"EKE {get_label_mplstr('EKE')}"
+
+    fig = plt.figure(figsize=(20,12))
+    for iax, (name, title) in enumerate([('model', '(a) BIOPERIANT12'), ('obs', '(b) OBS')]):
+        eke = inputs[name].eke
+        ax = add_stereo_axes(fig, 231 + iax)
+        mesh = ax.pcolormesh(eke.lon, eke.lat, eke, norm=norm_eke, cmap=cmap_eke,
+                             transform=ccrs.PlateCarree(), zorder=0)
+        cb = plt.colorbar(mesh, ax=ax, shrink=0.8, aspect=25, pad=0.08)
+        cb.set_label(eke_label, rotation=-90, labelpad=15)
+        ax.set_title(title, loc='left', fontsize=12)
+        maps.map_decorator(ax)
+    return fig
+
+########## f06 ################
+
+def plot_f06a(inputs):
+    '''
+    mean biomes of (a) the model and (b) Fay and McKinley (2014)
+    with the climatological SAF and PF of each
+    inputs: model (biomes), obs (MeanBiomes); the front files 
+            read by maps.add_fronts are listed in the spec too
+    '''
+    cmap_biome = colors.ListedColormap([get_biome_colors(biome) for biome in BIOME_BOUNDS])
+    norm_biome = colors.BoundaryNorm(BIOME_BOUNDS, cmap_biome.N)
+    biomes_obs = inputs['obs'].MeanBiomes
+    biomes_obs = biomes_obs.where(biomes_obs.lat < -30, np.nan).transpose()
+    panels = [(inputs['model'].biomes, '(a) BIOPERIANT12', 'mdl'),
+              (biomes_obs, '(b) OBS', 'obs')]
+
+    fig = plt.figure(figsize=(16,9))
+    for iax, (biomes, title, dataset) in enumerate(panels):
+        ax = add_stereo_axes(fig, 1, 3, iax+1)
+        mesh = ax.pcolormesh(biomes.lon, biomes.lat, biomes, norm=norm_biome, cmap=cmap_biome,
+                             transform=ccrs.PlateCarree(), zorder=0)
+        cb = plt.colorbar(mesh, ax=ax, ticks=BIOME_TICKS, orientation='vertical',
+                          shrink=0.4, aspect=25, pad=0.08)
+        cb.ax.set_title('biomes', fontsize=10, fontweight='normal', loc='left')
+        cb.ax.set_yticklabels(BIOME_LABELS)
+        ax.set_title(title, loc='left', fontsize=12)
+        maps.map_decorator(ax)
+        maps.add_fronts(ax, -1, dataset=dataset)
+    fig.tight_layout()
+    return fig
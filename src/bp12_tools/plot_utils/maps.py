@@ -1,11 +1,17 @@
+import os
+import pickle
+import hashlib
 import numpy as np
 import xarray as xr
 import pandas as pd
+from shapely import wkb
+from shapely.ops import clip_by_rect
 
 import sys
 sys.path.insert(0, '../')
 from bp12_tools.plot_utils.formatting import get_biome_colors, get_rbg_colors
 from bp12_tools.analysis_utils import pfloor, pceil
+from bp12_tools.grid_utils import get_cell_edges
 
 from cartopy import crs as ccrs, feature as cfeature
 from cartopy.io.shapereader import Reader
@@ -27,16 +33,26 @@ warnings.simplefilter('ignore')
 #
 ################################################### 
 
+MAP_SHAPEDIR = '../data/cartopy_shapefiles'
+MAP_CACHEDIR = f"{MAP_SHAPEDIR}/.cache"
+# lon0, lon1, lat0, lat1 of the stereographic maps
+MAP_EXTENT = (-180, 180, -90, -30)
+# clipped / projected shapefile geometries and features
+_MAP_GEOMS = {}
+# coarsened copies of map fields, one list per (field, how)
+_MAP_PYRAMIDS = {}
+# raster -> field index maps, one per (axes size, projection, grid)
+_MAP_WARPS = {}
 
 ########### Map plotting #########################
 def map_decorator(axin):
     '''
     In a cartopy stereographic map add coast, land and gridlines
     '''
-    land_feature, coast_feature = get_cartopy_landcoast()
+    land_feature, coast_feature = get_cartopy_landcoast(axin.projection)
     axin.gridlines(alpha=1, linewidth=0.35, linestyle='--', ylocs=np.arange(-80,0,10))
     axin.set_global()
-    axin.set_extent([-180, 180, -90, -30], ccrs.PlateCarree())
+    axin.set_extent(list(MAP_EXTENT), ccrs.PlateCarree())
     axin.add_feature(land_feature, color='white', zorder=10)
     axin.add_feature(coast_feature, lw=2, color='k', zorder=8)
     gl = axin.gridlines(draw_labels=False,color='k',lw=0.1,alpha=0.4)
@@ -44,18 +60,176 @@ def map_decorator(axin):
     axin.outline_patch.set_linewidth(1.5)
     axin.set_rasterized(True)
     
-def get_cartopy_landcoast():
+def get_cartopy_geometries(shapefile, extent=MAP_EXTENT):
     '''
-    Returns local coast and land shapefiles for cartopy plots
+    Returns the geometries of a shapefile clipped to the map extent 
+    (lon0, lon1, lat0, lat1), read once per process
     '''
-    coastfile = f'../data/cartopy_shapefiles/ne_10m_coastline.shp'
-    coast_feature = ShapelyFeature(Reader(coastfile).geometries(),
-                                     ccrs.PlateCarree(), lw=1.5, edgecolor='k', facecolor='w')
+    key = (shapefile, tuple(extent))
+    if key not in _MAP_GEOMS:
+        lon0, lon1, lat0, lat1 = extent
+        geoms = [clip_by_rect(geom, lon0, lat0, lon1, lat1) 
+                 for geom in Reader(shapefile).geometries()]
+        _MAP_GEOMS[key] = [geom for geom in geoms if not geom.is_empty]
+    return _MAP_GEOMS[key]
 
-    landfile = f'../data/cartopy_shapefiles/ne_10m_land.shp'
-    land_feature = ShapelyFeature(Reader(landfile).geometries(),
-                                     ccrs.PlateCarree(), color='w')
-    return land_feature, coast_feature
+def get_projected_geometries(shapefile, target_crs, extent=MAP_EXTENT, usedisk=True):
+    '''
+    Returns the clipped geometries of a shapefile projected to target_crs,
+    cached in memory per (shapefile, crs) and, with usedisk, as WKB in 
+    MAP_CACHEDIR keyed on the crs and shapefile mtime
+    '''
+    key = (shapefile, target_crs.proj4_init, tuple(extent))
+    if key in _MAP_GEOMS:
+        return _MAP_GEOMS[key]
+    stamp = hashlib.sha1(repr((key, os.stat(shapefile).st_mtime_ns)).encode()).hexdigest()[:16]
+    cachefile = f"{MAP_CACHEDIR}/{os.path.basename(shapefile)[:-4]}_{stamp}.pkl"
+    if usedisk and os.path.isfile(cachefile):
+        with open(cachefile, 'rb') as f:
+            geoms = [wkb.loads(geom) for geom in pickle.load(f)]
+    else:
+        geoms = [target_crs.project_geometry(geom, ccrs.PlateCarree())
+                 for geom in get_cartopy_geometries(shapefile, extent)]
+        geoms = [geom for geom in geoms if not geom.is_empty]
+        if usedisk:
+            os.makedirs(MAP_CACHEDIR, exist_ok=True)
+            tmpfile = f"{cachefile}.{os.getpid()}"
+            with open(tmpfile, 'wb') as f:
+                pickle.dump([wkb.dumps(geom) for geom in geoms], f)
+            os.replace(tmpfile, cachefile)
+    _MAP_GEOMS[key] = geoms
+    return geoms
+
+def get_cartopy_landcoast(target_crs=None, usedisk=True):
+    '''
+    Returns local coast and land shapefiles for cartopy plots,
+    clipped to MAP_EXTENT. With target_crs (e.g. axin.projection) the 
+    features are already projected so cartopy draws them as they are.
+    Features are built once per process and crs.
+    '''
+    key = ('features', None if target_crs is None else target_crs.proj4_init)
+    if key not in _MAP_GEOMS:
+        geoms = {}
+        for name in ['coastline', 'land']:
+            shapefile = f"{MAP_SHAPEDIR}/ne_10m_{name}.shp"
+            if target_crs is None:
+                geoms[name] = get_cartopy_geometries(shapefile)
+            else:
+                geoms[name] = get_projected_geometries(shapefile, target_crs, usedisk=usedisk)
+        feature_crs = ccrs.PlateCarree() if target_crs is None else target_crs
+        coast_feature = ShapelyFeature(geoms['coastline'], feature_crs, 
+                                       lw=1.5, edgecolor='k', facecolor='w')
+        land_feature = ShapelyFeature(geoms['land'], feature_crs, color='w')
+        _MAP_GEOMS[key] = (land_feature, coast_feature)
+    return _MAP_GEOMS[key]
+
+########### Fast maps #########################
+
+def get_map_pyramid(var_in, how='mean', maxlevel=6):
+    '''
+    Returns [var_in, var_in coarsened 2x2, 4x4, ...] of a (lat, lon)
+    field, built once per field. how='mean' keeps the area mean 
+    (NaN cells left out), how='min'/'max' the extremes.
+    '''
+    values = np.ascontiguousarray(var_in.values)
+    key = (var_in.name, values.shape, how, hashlib.sha1(values.tobytes()).hexdigest())
+    if key not in _MAP_PYRAMIDS:
+        pyramid = [var_in]
+        while (len(pyramid) <= maxlevel) and (min(pyramid[-1].shape) >= 4):
+            coarse = pyramid[-1].coarsen(lat=2, lon=2, boundary='trim')
+            pyramid.append(getattr(coarse, how)())
+        _MAP_PYRAMIDS[key] = pyramid
+    return _MAP_PYRAMIDS[key]
+
+def get_axes_pixels(axin, dpi=None):
+    '''
+    size (width, height) in output pixels of an axes when saved at dpi
+    (default savefig.dpi)
+    '''
+    dpi = dpi or mpl.rcParams['savefig.dpi']
+    if not isinstance(dpi, (int, float)):
+        dpi = axin.figure.dpi
+    bbox = axin.get_window_extent()
+    scale = dpi / axin.figure.dpi
+    return max(int(bbox.width * scale), 1), max(int(bbox.height * scale), 1)
+
+def get_pyramid_level(pyramid, axin, dpi=None):
+    '''
+    Index of the coarsest pyramid level whose largest cell on the 
+    axes is still at most one output pixel. Cell sizes are measured 
+    along the northern and southern edge of the extent on the map.
+    '''
+    var = pyramid[0]
+    npix = get_axes_pixels(axin, dpi)
+    proj = getattr(axin, 'projection', None)
+    lat = var.lat.values
+    ilat = np.unique([0, lat.size - 2, lat.size // 2])
+    lons = var.lon.values[::max(var.lon.size // 64, 1)]
+    lons2 = np.r_[lons, lons + np.diff(var.lon.values[:2])]
+    lon2d, lat2d = np.meshgrid(lons2, np.r_[lat[ilat], lat[ilat + 1]])
+    if proj is not None:
+        xy = proj.transform_points(ccrs.PlateCarree(), lon2d, lat2d)[..., :2]
+    else:
+        xy = np.stack([lon2d, lat2d], axis=-1)
+    x0, x1, y0, y1 = axin.get_extent() if proj is not None else (*axin.get_xlim(), *axin.get_ylim())
+    pix = xy / np.array([abs(x1 - x0) / npix[0], abs(y1 - y0) / npix[1]])
+    nlon, nrow = lons.size, ilat.size
+    dlon = np.hypot(*(pix[:nrow, nlon:] - pix[:nrow, :nlon]).T.reshape(2, -1))
+    dlat = np.hypot(*(pix[nrow:, :nlon] - pix[:nrow, :nlon]).T.reshape(2, -1))
+    cellpix = np.nanmax(np.r_[dlon, dlat])
+    level = int(np.floor(np.log2(1 / cellpix))) if cellpix < 1 else 0
+    return int(np.clip(level, 0, len(pyramid) - 1))
+
+def get_map_warp(axin, lon, lat, dpi=None):
+    '''
+    For each output pixel of a map axes, the flat index of the 
+    (lat, lon) cell under it, -1 outside the grid. Cached per axes 
+    size, projection, extent and grid.
+    '''
+    npix = get_axes_pixels(axin, dpi)
+    extent = tuple(axin.get_extent())
+    key = (npix, axin.projection.proj4_init, extent, 
+           lon.size, lon[0], lon[-1], lat.size, lat[0], lat[-1])
+    if key not in _MAP_WARPS:
+        x0, x1, y0, y1 = extent
+        x = x0 + (np.arange(npix[0]) + 0.5) * (x1 - x0) / npix[0]
+        y = y0 + (np.arange(npix[1]) + 0.5) * (y1 - y0) / npix[1]
+        x2d, y2d = np.meshgrid(x, y)
+        lonlat = ccrs.PlateCarree().transform_points(axin.projection, x2d, y2d)
+        lonedges, latedges = get_cell_edges(lon), get_cell_edges(lat)
+        lonq = lonedges[0] + np.mod(lonlat[..., 0] - lonedges[0], 360)
+        ilon = np.clip(np.searchsorted(lonedges, lonq, side='right') - 1, 0, lon.size - 1)
+        ilat = np.searchsorted(latedges, lonlat[..., 1], side='right') - 1
+        valid = (ilat >= 0) & (ilat < lat.size) & np.isfinite(lonlat[..., 1])
+        _MAP_WARPS[key] = np.where(valid, ilat * lon.size + ilon, -1)
+    return _MAP_WARPS[key]
+
+def plot_map(axin, var_in, how='mean', fast=True, dpi=None, **kwargs):
+    '''
+    Plot a (lat, lon) field on a map axes at the resolution of the 
+    output: the field is taken from its coarsened pyramid at the 
+    level matching the axes pixel size and, on cartopy axes, drawn 
+    with imshow as a raster already warped to the map projection.
+    Without fast (or on non-map axes) the pyramid level is drawn 
+    with a rasterized pcolormesh. Call after the extent is set
+    (e.g. map_decorator); kwargs go to imshow/pcolormesh (cmap, norm, 
+    vmin, vmax, zorder, ...).
+    returns the artist
+    '''
+    pyramid = get_map_pyramid(var_in, how)
+    var = pyramid[get_pyramid_level(pyramid, axin, dpi)]
+    proj = getattr(axin, 'projection', None)
+    if fast and (proj is not None):
+        lon, lat = var.lon.values, var.lat.values
+        warp = get_map_warp(axin, lon, lat, dpi)
+        raster = np.where(warp >= 0, var.values.ravel()[np.maximum(warp, 0)], np.nan)
+        return axin.imshow(np.ma.masked_invalid(raster), origin='lower', 
+                           extent=axin.get_extent(), transform=proj, 
+                           interpolation='nearest', **kwargs)
+    if proj is not None:
+        kwargs.setdefault('transform', ccrs.PlateCarree())
+    return axin.pcolormesh(var.lon, var.lat, var.values, shading='auto', 
+                           rasterized=True, **kwargs)
 
 def get_cmap_mask():
     '''
@@ -0,0 +1,213 @@
+import os
+import sys
+import glob
+import json
+import time
+import inspect
+import hashlib
+import argparse
+import importlib
+import xarray as xr
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+###################################################
+#
+# Contains a runner rendering the manuscript figures
+# from declarative specs in parallel processes
+#
+# Python:  run_figures(specs)
+# Shell:   python -m bp12_tools.plot_utils.runner -h
+#          (from notebooks/: ... runner ../figures/figure_specs.json)
+#
+# spec = {'name':    'f07',
+#         'plot':    'module.path:function',  # function(inputs, **kwargs) -> Figure
+#         'inputs':  {'biome': '../data/BIOMES/..._meanbiome_clim.nc', ...},
+#         'outfile': '../figures/f07.png',
+#         'kwargs':  {...}}                     # optional, JSON serializable
+#
+###################################################
+
+FIG_MANIFEST = '.figure_manifest.json'
+FIG_HASHBLOCK = 2**20
+# packages of plot helpers whose sources are part of every figure hash
+FIG_HELPERS = ['bp12_tools.plot_utils']
+# opened input datasets, one per (path, mtime) in each worker
+_FIG_INPUTS = {}
+
+########## hashes ################
+
+def get_file_hash(filename):
+    '''
+    sha1 of the file contents, read in blocks
+    '''
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(FIG_HASHBLOCK), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def get_input_hashes(filenames, known=None):
+    '''
+    content hash of every input file, reusing hashes in known
+    {path: [mtime_ns, size, sha1]} for files whose stat is unchanged
+    returns the updated {path: [mtime_ns, size, sha1]}
+    '''
+    known = known or {}
+    hashes = {}
+    for filename in sorted(set(filenames)):
+        st = os.stat(filename)
+        entry = known.get(filename)
+        if (entry is None) or (entry[:2] != [st.st_mtime_ns, st.st_size]):
+            entry = [st.st_mtime_ns, st.st_size, get_file_hash(filename)]
+        hashes[filename] = entry
+    return hashes
+
+def get_plot_source_hash(plot):
+    '''
+    sha1 of the sources of the module holding a plot function and of
+    the helper packages (FIG_HELPERS: maps, formatting, ...), so figures
+    are redrawn when the plotting code changes
+    '''
+    sha = hashlib.sha1()
+    for modname in [plot.split(':')[0]] + FIG_HELPERS:
+        mod = importlib.import_module(modname)
+        if hasattr(mod, '__path__'):
+            filenames = sorted(glob.glob(f"{mod.__path__[0]}/*.py"))
+        else:
+            filenames = [inspect.getsourcefile(mod)]
+        for filename in filenames:
+            sha.update(f"{modname}:{os.path.basename(filename)}".encode())
+            sha.update(get_file_hash(filename).encode())
+    return sha.hexdigest()
+
+def get_spec_hash(spec, input_hashes):
+    '''
+    hash of a figure spec, the source of its plot module 
+    and the contents of its inputs
+    '''
+    key = {'plot': spec['plot'], 'kwargs': spec.get('kwargs', {}),
+           'source': get_plot_source_hash(spec['plot']),
+           'inputs': {name: input_hashes[path][2] for name, path in spec['inputs'].items()}}
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+def read_manifest(manifestfile):
+    if not os.path.exists(manifestfile):
+        return {'inputs': {}, 'figures': {}}
+    with open(manifestfile) as f:
+        return json.load(f)
+
+def write_manifest(manifestfile, manifest):
+    tmpfile = f"{manifestfile}.{os.getpid()}"
+    with open(tmpfile, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmpfile, manifestfile)
+
+########## rendering ################
+
+def _init_worker():
+    import matplotlib
+    import bp12_tools.plot_utils as pu
+    matplotlib.use('Agg')
+    pu.set_style()
+
+def get_figure_input(filename):
+    '''
+    returns the dataset of an input file, loaded into memory once
+    per process and shared by all figures using it
+    '''
+    key = (filename, os.stat(filename).st_mtime_ns)
+    if key not in _FIG_INPUTS:
+        with xr.open_dataset(filename) as ds_in:
+            _FIG_INPUTS[key] = ds_in.load()
+    return _FIG_INPUTS[key]
+
+def get_plot_function(plot):
+    modname, funcname = plot.split(':')
+    return getattr(importlib.import_module(modname), funcname)
+
+def render_figures(specs, savekw=None):
+    '''
+    render figures in this process, inputs shared between 
+    them (or with earlier figures of this worker) are read once
+    returns (name, seconds, error) per figure, error is None on success
+    '''
+    import matplotlib.pyplot as plt
+    done = []
+    for spec in specs:
+        t0 = time.time()
+        try:
+            inputs = {name: get_figure_input(path) for name, path in spec['inputs'].items()}
+            fig = get_plot_function(spec['plot'])(inputs, **spec.get('kwargs', {}))
+            os.makedirs(os.path.dirname(os.path.abspath(spec['outfile'])), exist_ok=True)
+            fig.savefig(spec['outfile'], **(savekw or {'bbox_inches': 'tight'}))
+            plt.close(fig)
+        except Exception as err:
+            plt.close('all')
+            done.append((spec['name'], round(time.time() - t0, 2), repr(err)))
+            continue
+        done.append((spec['name'], round(time.time() - t0, 2), None))
+    return done
+
+########## driver ################
+
+def run_figures(specs, nworkers=4, force=False, manifestfile=FIG_MANIFEST, savekw=None):
+    '''
+    Render figures from specs (see the module header) in parallel
+    on nworkers processes with the Agg backend, one task per figure;
+    each worker keeps the inputs it has read (get_figure_input).
+    A figure is skipped when its output exists and the hash of its 
+    spec, plot sources and input file contents matches the manifest, 
+    unless force.
+    returns the names of the figures rendered
+    '''
+    manifest = read_manifest(manifestfile)
+    manifest['inputs'] = get_input_hashes([path for spec in specs for path in spec['inputs'].values()],
+                                          manifest['inputs'])
+    hashes = {spec['name']: get_spec_hash(spec, manifest['inputs']) for spec in specs}
+    todo = [spec for spec in specs if force or (not os.path.exists(spec['outfile']))
+            or (manifest['figures'].get(spec['name']) != hashes[spec['name']])]
+    for spec in specs:
+        if spec not in todo:
+            print(f"{spec['name']}: up to date")
+    if not todo:
+        write_manifest(manifestfile, manifest)
+        return []
+
+    rendered = []
+    with ProcessPoolExecutor(max_workers=min(nworkers, len(todo)), initializer=_init_worker) as pool:
+        futures = {pool.submit(render_figures, [spec], savekw): spec for spec in todo}
+        for future in as_completed(futures):
+            try:
+                done = future.result()
+            except Exception as err:
+                print(f"{futures[future]['name']}: failed ({err})")
+                continue
+            for name, seconds, error in done:
+                if error is not None:
+                    print(f"{name}: failed ({error})")
+                    continue
+                manifest['figures'][name] = hashes[name]
+                print(f"{name}: rendered in {seconds} s")
+                rendered.append(name)
+    write_manifest(manifestfile, manifest)
+    return rendered
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Render BIOPERIANT12 figures from a JSON list of specs')
+    parser.add_argument('specfile')
+    parser.add_argument('--only', nargs='+', help='names of the figures to render')
+    parser.add_argument('--nworkers', type=int, default=4)
+    parser.add_argument('--manifest', default=FIG_MANIFEST)
+    parser.add_argument('--force', action='store_true')
+    args = parser.parse_args(argv)
+
+    with open(args.specfile) as f:
+        specs = json.load(f)
+    if args.only:
+        specs = [spec for spec in specs if spec['name'] in args.only]
+    run_figures(specs, args.nworkers, args.force, args.manifest)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
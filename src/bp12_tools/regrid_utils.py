@@ -0,0 +1,217 @@
+import os
+import hashlib
+import numpy as np
+import xarray as xr
+from scipy import sparse
+import bp12_tools.grid_utils as gu
+
+###################################################
+#
+# Contains functions for regridding fields on the
+# sorted model grid to regular obs grids with
+# sparse weight matrices cached on disk
+#
+###################################################
+
+REGRID_METHODS = ['conservative', 'bilinear', 'mode']
+REGRID_CACHE = f"{gu.BP12_GRIDDIR}/.regridcache"
+# sparse weights, one per (method, grid axes) key
+_REGRID_WEIGHTS = {}
+
+########## obs grids ################
+
+def make_obs_grid(res, lon0=-180., lat0=-90., lat1=90.):
+    '''
+    cell centres (lon, lat) of a regular res degree grid
+    '''
+    nlon, nlat = int(round(360 / res)), int(round((lat1 - lat0) / res))
+    lon = lon0 + res * (np.arange(nlon) + 0.5)
+    lat = lat0 + res * (np.arange(nlat) + 0.5)
+    return lon, lat
+
+OBS_GRIDS = {
+    '1deg':   make_obs_grid(1.),
+    '025deg': make_obs_grid(0.25),
+    'WOA13':  make_obs_grid(1.),
+}
+
+########## weights ################
+
+def get_overlap_1d(edges_in, edges_out, period=None):
+    '''
+    sparse (nout, nin) matrix of the length each input cell shares
+    with each output cell along one axis (ascending edges),
+    with input cells shifted by +-period on a periodic axis
+    '''
+    nin, nout = edges_in.size - 1, edges_out.size - 1
+    shifts = [0.] if period is None else [-period, 0., period]
+    rows, cols, vals = [], [], []
+    for shift in shifts:
+        e_in = edges_in + shift
+        pts = np.unique(np.r_[e_in, edges_out])
+        mids = 0.5 * (pts[1:] + pts[:-1])
+        iin = np.searchsorted(e_in, mids) - 1
+        iout = np.searchsorted(edges_out, mids) - 1
+        ok = (iin >= 0) & (iin < nin) & (iout >= 0) & (iout < nout)
+        rows.append(iout[ok])
+        cols.append(iin[ok])
+        vals.append(np.diff(pts)[ok])
+    return sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(nout, nin))
+
+def get_linear_1d(axis_in, axis_out, period=None):
+    '''
+    sparse (nout, nin) matrix of linear interpolation weights along
+    one axis (ascending), output points outside the input axis get
+    no weights unless the axis is periodic
+    '''
+    nin = axis_in.size
+    cols_in = np.arange(nin)
+    if period is not None:
+        axis_out = axis_in[0] + np.mod(axis_out - axis_in[0], period)
+        axis_in = np.r_[axis_in[-1] - period, axis_in, axis_in[0] + period]
+        cols_in = np.r_[nin - 1, cols_in, 0]
+    i1 = np.clip(np.searchsorted(axis_in, axis_out), 1, axis_in.size - 1)
+    i0 = i1 - 1
+    w1 = (axis_out - axis_in[i0]) / (axis_in[i1] - axis_in[i0])
+    ok = (w1 >= 0) & (w1 <= 1)
+    rows = np.arange(axis_out.size)[ok]
+    return sparse.csr_matrix((np.r_[1 - w1[ok], w1[ok]],
+                              (np.r_[rows, rows], np.r_[cols_in[i0[ok]], cols_in[i1[ok]]])),
+                             shape=(axis_out.size, nin))
+
+def make_regrid_weights(lon_in, lat_in, lon_out, lat_out, method='conservative'):
+    '''
+    sparse (nout, nin) weights from a (lat, lon) grid to another,
+    flattened row-major. The grids are rectilinear so the weights
+    are the Kronecker product of the lat and lon weights:
+    conservative/mode: area of each input cell (make_obs_areagrid)
+                       falling in each output cell
+    bilinear:          bilinear interpolation weights
+    '''
+    lon_in, lat_in = np.asarray(lon_in, dtype=float), np.asarray(lat_in, dtype=float)
+    lon_out, lat_out = np.asarray(lon_out, dtype=float), np.asarray(lat_out, dtype=float)
+    if method == 'bilinear':
+        return sparse.kron(get_linear_1d(lat_in, lat_out),
+                           get_linear_1d(lon_in, lon_out, period=360.), format='csr')
+    if method not in ['conservative', 'mode']:
+        return None
+
+    lonedges_in, lonedges_out = gu.get_cell_edges(lon_in), gu.get_cell_edges(lon_out)
+    sinedges_in = np.sin(np.deg2rad(np.clip(gu.get_cell_edges(lat_in), -90, 90)))
+    sinedges_out = np.sin(np.deg2rad(np.clip(gu.get_cell_edges(lat_out), -90, 90)))
+    # overlaps as fractions of the input cell
+    frac_lon = get_overlap_1d(lonedges_in, lonedges_out, period=360.) \
+               @ sparse.diags(1 / np.diff(lonedges_in))
+    frac_lat = get_overlap_1d(sinedges_in, sinedges_out) @ sparse.diags(1 / np.diff(sinedges_in))
+    area_in = gu.make_obs_areagrid(lon_in, lat_in).ravel()
+    return (sparse.kron(frac_lat, frac_lon, format='csr') @ sparse.diags(area_in)).tocsr()
+
+def _get_weights_key(lon_in, lat_in, lon_out, lat_out, method):
+    sha = hashlib.sha1(method.encode())
+    for axis in [lon_in, lat_in, lon_out, lat_out]:
+        sha.update(np.ascontiguousarray(axis, dtype=float).tobytes())
+    return sha.hexdigest()[:16]
+
+def get_regrid_weights(lon_out, lat_out, method='conservative', lon_in=None, lat_in=None):
+    '''
+    returns the sparse weights from the sorted model grid (or lon_in,
+    lat_in) to the obs grid (lon_out, lat_out), computed once and
+    saved as .npz in the regrid cache directory; within a process
+    the matrix is reused. mode uses the conservative weights.
+    '''
+    if method not in REGRID_METHODS:
+        return None
+    if lon_in is None:
+        grid = gu.get_sortedgrid()
+        lon_in, lat_in = grid.lon, grid.lat
+    wmethod = 'conservative' if method == 'mode' else method
+    key = _get_weights_key(lon_in, lat_in, lon_out, lat_out, wmethod)
+    if key in _REGRID_WEIGHTS:
+        return _REGRID_WEIGHTS[key]
+
+    wfile = f"{REGRID_CACHE}/{wmethod}_{key}.npz"
+    if os.path.isfile(wfile):
+        weights = sparse.load_npz(wfile).tocsr()
+    else:
+        weights = make_regrid_weights(lon_in, lat_in, lon_out, lat_out, wmethod)
+        os.makedirs(REGRID_CACHE, exist_ok=True)
+        tmpfile = f"{REGRID_CACHE}/{wmethod}_{key}.{os.getpid()}.npz"
+        sparse.save_npz(tmpfile, weights)
+        os.replace(tmpfile, wfile)
+    _REGRID_WEIGHTS[key] = weights
+    return weights
+
+########## apply ################
+
+def _regrid_core(x, weights, nout, minfrac=0.):
+    '''
+    weighted mean of the valid input cells of x (..., lat, lon)
+    in each output cell with one sparse product per block
+    '''
+    shape = x.shape[:-2]
+    x = np.asarray(x, dtype=float).reshape(-1, x.shape[-2] * x.shape[-1]).T
+    valid = ~np.isnan(x)
+    num = weights @ np.where(valid, x, 0)
+    tot = weights @ valid.astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rowsum = np.asarray(weights.sum(axis=1))
+        out = np.where((tot > 0) & (tot >= minfrac * rowsum), num / tot, np.nan)
+    return out.T.reshape(shape + nout)
+
+def _regrid_mode_core(x, weights, nout, classes):
+    '''
+    class covering the largest area of each output cell
+    '''
+    shape = x.shape[:-2]
+    x = np.asarray(x).reshape(-1, x.shape[-2] * x.shape[-1]).T
+    cover = np.stack([weights @ (x == val).astype(float) for val in classes])
+    out = np.where(cover.max(axis=0) > 0, classes[np.argmax(cover, axis=0)], np.nan)
+    return out.T.reshape(shape + nout)
+
+def regrid_bp12var(var_in, lon_out, lat_out, method='conservative', minfrac=0., 
+                   classes=None, tchunk=1):
+    '''
+    Regrid a DataArray (..., lat, lon) on the sorted model grid to
+    the obs grid (lon_out, lat_out), e.g. OBS_GRIDS['1deg'].
+    conservative: area weighted mean of the model cells in each obs cell
+    bilinear:     bilinear interpolation to the obs cell centres
+    mode:         majority class (biome masks etc.) by area, among classes
+                  (by default the values of var_in, found chunk by chunk)
+    NaNs are left out and the weights renormalized, obs cells where
+    the valid cells carry less than minfrac of the weight are NaN. Dask arrays are regridded
+    in parallel in blocks of tchunk time steps over the whole domain.
+    '''
+    weights = get_regrid_weights(lon_out, lat_out, method)
+    if weights is None:
+        return None
+    lon_out, lat_out = np.asarray(lon_out), np.asarray(lat_out)
+    nout = (lat_out.size, lon_out.size)
+    if var_in.chunks is not None:
+        chunks = {'lat': -1, 'lon': -1}
+        if 'time' in var_in.dims:
+            chunks['time'] = tchunk
+        var_in = var_in.chunk(chunks)
+    if method == 'mode':
+        if classes is None:
+            if var_in.chunks is not None:
+                import dask.array as da
+                classes = da.unique(var_in.data).compute()
+            else:
+                classes = np.unique(var_in.values)
+        classes = np.asarray(classes)
+        if classes.dtype.kind == 'f':
+            classes = classes[~np.isnan(classes)]
+        func, kwargs = _regrid_mode_core, {'classes': classes}
+    else:
+        func, kwargs = _regrid_core, {'minfrac': minfrac}
+    kwargs.update(weights=weights, nout=nout)
+
+    var_out = xr.apply_ufunc(func, var_in, kwargs=kwargs,
+                             input_core_dims=[['lat', 'lon']],
+                             output_core_dims=[['lat', 'lon']],
+                             exclude_dims={'lat', 'lon'},
+                             dask='parallelized', output_dtypes=[float],
+                             dask_gufunc_kwargs={'output_sizes': {'lat': nout[0], 'lon': nout[1]}},
+                             keep_attrs=True)
+    return var_out.assign_coords(lat=lat_out, lon=lon_out)